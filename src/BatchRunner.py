@@ -0,0 +1,221 @@
+"""
+Пакетный прогон сценариев диалогов с персонажами без Telegram.
+
+Каждая строка входного JSONL - один сценарий:
+    {"id": "batman-1", "character": "Бэтмен", "turns": ["Привет!", "Кто ты?"]}
+    {"id": "fight-1", "character": "Дракула", "fight": {"enemy": "Ван Хельсинг", "instructions": "серебряный кинжал"}}
+Поля turns и fight можно указывать вместе: сначала идут реплики, затем бой.
+
+Персонажи создаются прямо из CharConfig.json, сценарии выполняются параллельно ограниченным
+пулом воркеров. Результаты дописываются в выходной JSONL по мере готовности (реплики, задержки, токены).
+Выходной файл служит и контрольной точкой: при повторном запуске уже выполненные
+сценарии пропускаются, а завершившиеся ошибкой - выполняются заново.
+
+Пример:
+    python BatchRunner.py scenarios.jsonl --output results.jsonl --workers 50
+"""
+from typing import Iterator, Optional, Set, Tuple
+import argparse
+import asyncio
+import json
+import os
+import time
+from dotenv import load_dotenv
+from CharLogic import Character
+from CharRegistry import CharacterRegistry
+from YandexAIConnector import get_dialogue_manager, startup as llm_startup, shutdown as llm_shutdown
+from Metrics import track_usage
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+_STOP = None  # Конец входного файла в очереди сценариев
+
+
+def read_scenarios(path: str) -> Iterator[Tuple[str, Optional[dict], Optional[str]]]:
+    """
+    Лениво читает сценарии из JSONL.
+
+    Yields:
+        Tuple[str, Optional[dict], Optional[str]]: Идентификатор, сценарий и ошибка разбора
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                scenario = json.loads(line)
+                if not isinstance(scenario, dict):
+                    raise ValueError("сценарий должен быть объектом")
+            except ValueError as e:
+                yield f"line-{number}", None, f"Некорректная строка {number}: {str(e)}"
+                continue
+            yield str(scenario.get('id', f"line-{number}")), scenario, None
+
+
+def load_completed(path: str) -> Set[str]:
+    """Идентификаторы сценариев, уже успешно выполненных в предыдущих запусках"""
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue  # Строка, недописанная при прерывании
+            if result.get('status') == 'ok':
+                completed.add(result['id'])
+    return completed
+
+
+class BatchRunner:
+    """Параллельный прогон сценариев с потоковой записью результатов"""
+
+    def __init__(self, input_path: str, output_path: str, workers: int, config_path: str,
+                 user: str = "Тестировщик", restart: bool = False):
+        """
+        Args:
+            input_path (str): Входной JSONL со сценариями
+            output_path (str): Выходной JSONL с результатами (он же контрольная точка)
+            workers (int): Число одновременно выполняемых сценариев
+            config_path (str): Путь к CharConfig.json
+            user (str): Имя пользователя в диалогах
+            restart (bool): Начать заново, не учитывая прежние результаты
+        """
+        self.input_path = input_path
+        self.output_path = output_path
+        self.workers = workers
+        self.registry = CharacterRegistry(config_path)
+        self.user = user
+        self.restart = restart
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self._output = None
+
+    async def run_scenario(self, scenario: dict) -> dict:
+        """Выполняет один сценарий и возвращает запись результата"""
+        key = scenario.get('character')
+        template = self.registry.get(key) if isinstance(key, str) else None
+        if template is None:
+            raise ValueError(f"Персонаж '{key}' не найден")
+        turns = scenario.get('turns', [])
+        fight = scenario.get('fight')
+        if not isinstance(turns, list) or not all(isinstance(t, str) for t in turns):
+            raise ValueError("Поле 'turns' должно быть списком строк")
+        if fight is not None and (not isinstance(fight, dict) or 'enemy' not in fight):
+            raise ValueError("Поле 'fight' должно содержать 'enemy'")
+        if not turns and fight is None:
+            raise ValueError("Сценарий не содержит ни реплик, ни боя")
+
+        character = Character.from_template(self.user, template, get_dialogue_manager())
+        replies = []
+        started = time.perf_counter()
+        with track_usage() as usage:
+            for text in turns:
+                turn_started = time.perf_counter()
+                reply = await character.add_user_message_async(text)
+                replies.append({'user': text, 'reply': reply,
+                                'latency': round(time.perf_counter() - turn_started, 4)})
+            if fight is not None:
+                turn_started = time.perf_counter()
+                reply = await character.let_fight_async(fight['enemy'], fight.get('instructions', ''))
+                replies.append({'fight': fight['enemy'], 'reply': reply,
+                                'latency': round(time.perf_counter() - turn_started, 4)})
+        return {
+            'character': key,
+            'turns': replies,
+            'latency': round(time.perf_counter() - started, 4),
+            'tokens': usage,
+        }
+
+    def _write(self, result: dict):
+        """Дописывает результат и сразу сбрасывает его на диск: файл служит контрольной точкой"""
+        self._output.write(json.dumps(result, ensure_ascii=False) + '\n')
+        self._output.flush()
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is _STOP:
+                return
+            scenario_id, scenario, error = item
+            result = {'id': scenario_id}
+            if error is None:
+                try:
+                    result.update(await self.run_scenario(scenario))
+                    result['status'] = 'ok'
+                    self.done += 1
+                except Exception as e:
+                    error = str(e)
+            if error is not None:
+                result.update(status='error', error=error)
+                self.failed += 1
+            self._write(result)
+
+    async def _report(self):
+        """Периодически печатает прогресс"""
+        while True:
+            await asyncio.sleep(10)
+            print(f"Выполнено {self.done}, ошибок {self.failed}, пропущено {self.skipped}")
+
+    async def run(self):
+        completed = set() if self.restart else load_completed(self.output_path)
+        broken_tail = False
+        if not self.restart and os.path.exists(self.output_path) and os.path.getsize(self.output_path):
+            with open(self.output_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                broken_tail = f.read(1) != b'\n'
+        self._output = open(self.output_path, 'w' if self.restart else 'a', encoding='utf-8')
+        if broken_tail:
+            self._output.write('\n')  # Последняя строка оборвана при прерывании: начинаем с новой
+
+        await llm_startup()
+        # Ограниченная очередь: входной файл читается по мере выполнения, а не целиком
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+        reporter = asyncio.create_task(self._report())
+        started = time.perf_counter()
+        try:
+            for scenario_id, scenario, error in read_scenarios(self.input_path):
+                if scenario_id in completed:
+                    self.skipped += 1
+                    continue
+                await queue.put((scenario_id, scenario, error))
+            for _ in workers:
+                await queue.put(_STOP)
+            await asyncio.gather(*workers)
+        finally:
+            reporter.cancel()
+            for worker in workers:
+                worker.cancel()
+            self._output.close()
+            await llm_shutdown()
+        print(f"Готово за {time.perf_counter() - started:.1f} с: выполнено {self.done}, "
+              f"ошибок {self.failed}, пропущено (уже выполнены) {self.skipped}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Пакетный прогон сценариев диалогов с персонажами")
+    parser.add_argument('input', help="Входной JSONL со сценариями")
+    parser.add_argument('--output', help="Выходной JSONL (по умолчанию <input>.results.jsonl)")
+    parser.add_argument('--workers', type=int, default=20, help="Число одновременно выполняемых сценариев")
+    parser.add_argument('--config', default=os.path.join(script_dir, 'CharConfig.json'), help="Конфигурация персонажей")
+    parser.add_argument('--user', default="Тестировщик", help="Имя пользователя в диалогах")
+    parser.add_argument('--restart', action='store_true', help="Начать заново, перезаписав выходной файл")
+    return parser.parse_args()
+
+
+def main():
+    load_dotenv()
+    args = parse_args()
+    output = args.output or os.path.splitext(args.input)[0] + '.results.jsonl'
+    runner = BatchRunner(args.input, output, args.workers, args.config, args.user, args.restart)
+    try:
+        asyncio.run(runner.run())
+    except KeyboardInterrupt:
+        print(f"Прервано. Готовые результаты сохранены в {output}, повторный запуск продолжит с места остановки.")
+
+
+if __name__ == "__main__":
+    main()
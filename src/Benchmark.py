@@ -0,0 +1,428 @@
+"""
+Нагрузочный тест бота без обращения к YandexGPT и Telegram.
+
+Модель DialogueManager подменяется локальной заглушкой с настраиваемыми задержкой,
+разбросом, скоростью генерации и долей ошибок, а context.bot - заглушкой Telegram Bot API.
+Сценарии вызывают обработчики BotMain так же, как это делает Application.
+
+Пример:
+    python Benchmark.py --chats 200 --messages 5 --latency 0.8 --output result.json
+    python Benchmark.py --compare old.json result.json
+"""
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+# Настройки должны быть заданы до импорта BotMain: он читает окружение при импорте
+os.environ.setdefault('BOT_TOKEN', 'benchmark')
+os.environ['SESSION_BACKEND'] = 'memory'
+os.environ.pop('JOURNAL_DIR', None)
+os.environ.setdefault('BROADCAST_RATE', '1000')
+os.environ.setdefault('BROADCAST_REPORT_INTERVAL', '3600')
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль q (0..100) по отсортированной копии значений"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(latencies: List[float], errors: int, duration: float) -> Dict[str, float]:
+    return {
+        'count': len(latencies),
+        'errors': errors,
+        'duration': round(duration, 4),
+        'throughput': round(len(latencies) / duration, 2) if duration > 0 else 0.0,
+        'p50': round(percentile(latencies, 50), 4),
+        'p95': round(percentile(latencies, 95), 4),
+        'p99': round(percentile(latencies, 99), 4),
+        'max': round(max(latencies), 4) if latencies else 0.0,
+    }
+
+
+# --- Заглушка YandexGPT ---
+
+class FakeModel:
+    """Локальная модель: отвечает после задержки, генерирует токены с заданной скоростью"""
+
+    def __init__(self, latency: float, jitter: float, token_rate: float, reply_tokens: int, failure_rate: float):
+        self.latency = latency
+        self.jitter = jitter
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.failure_rate = failure_rate
+        self.calls = 0
+
+    def _first_token_delay(self) -> float:
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def _check_failure(self):
+        if random.random() < self.failure_rate:
+            raise RuntimeError("Имитация ошибки модели")
+
+    @staticmethod
+    def _result(text: str, input_tokens: int, completion_tokens: int):
+        return SimpleNamespace(
+            alternatives=(SimpleNamespace(role='assistant', text=text),),
+            usage=SimpleNamespace(input_text_tokens=input_tokens, completion_tokens=completion_tokens,
+                                  total_tokens=input_tokens + completion_tokens)
+        )
+
+    @staticmethod
+    def _input_tokens(messages) -> int:
+        return sum(len(m['text']) // 3 + 1 for m in messages)
+
+    def _text(self, tokens: int) -> str:
+        return ' '.join('слово' for _ in range(tokens))
+
+    async def run(self, messages, timeout=60):
+        self.calls += 1
+        messages = list(messages)
+        await asyncio.sleep(self._first_token_delay() + self.reply_tokens / self.token_rate)
+        self._check_failure()
+        return self._result(self._text(self.reply_tokens), self._input_tokens(messages), self.reply_tokens)
+
+    async def run_stream(self, messages, timeout=60):
+        self.calls += 1
+        messages = list(messages)
+        await asyncio.sleep(self._first_token_delay())
+        self._check_failure()
+        chunk = max(1, int(self.token_rate / 10))  # Примерно десять частичных результатов в секунду
+        for produced in range(chunk, self.reply_tokens + chunk, chunk):
+            produced = min(produced, self.reply_tokens)
+            await asyncio.sleep(chunk / self.token_rate)
+            yield self._result(self._text(produced), self._input_tokens(messages), produced)
+
+
+class FakeSyncModel:
+    """Синхронная обертка над FakeModel для путей, вызывающих model.run напрямую"""
+
+    def __init__(self, model: FakeModel):
+        self.model = model
+
+    def run(self, messages, timeout=60):
+        return asyncio.run(self.model.run(messages, timeout=timeout))
+
+
+class FakePool:
+    """Замена ClientPool: вместо SDK выдает локальные модели"""
+
+    def __init__(self, model: FakeModel):
+        self.model = model
+
+    def get_models(self, model_name: str, temperature: float):
+        return FakeSyncModel(self.model), self.model
+
+    async def close(self):
+        pass
+
+
+# --- Заглушка Telegram ---
+
+class FakeBot:
+    """In-process замена Bot API с настраиваемой задержкой ответа"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.sent = 0
+        self.edited = 0
+        self._message_id = 0
+
+    async def _call(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self._message_id += 1
+        return SimpleNamespace(message_id=self._message_id)
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        self.sent += 1
+        return await self._call()
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.edited += 1
+        return await self._call()
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        return await self._call()
+
+
+class FakeApplication:
+    def __init__(self):
+        self.tasks: List[asyncio.Task] = []
+
+    def create_task(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+
+def make_context(bot: FakeBot, application: FakeApplication, args: Optional[List[str]] = None):
+    return SimpleNamespace(bot=bot, application=application, args=args or [])
+
+
+def make_update(chat_id: int, text: str = ''):
+    return SimpleNamespace(
+        effective_chat=SimpleNamespace(id=chat_id),
+        message=SimpleNamespace(text=text)
+    )
+
+
+def make_callback_update(chat_id: int, data: str):
+    async def answer():
+        pass
+
+    async def edit_message_text(text, **kwargs):
+        pass
+
+    query = SimpleNamespace(
+        data=data,
+        message=SimpleNamespace(chat=SimpleNamespace(id=chat_id)),
+        answer=answer,
+        edit_message_text=edit_message_text
+    )
+    return SimpleNamespace(callback_query=query, effective_chat=SimpleNamespace(id=chat_id))
+
+
+# --- Измерения ---
+
+class LoopLagMonitor:
+    """Измеряет задержку цикла событий: насколько позже запланированного просыпается задача"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> Dict[str, float]:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        return {
+            'p50': round(percentile(self.samples, 50), 4),
+            'p99': round(percentile(self.samples, 99), 4),
+            'max': round(max(self.samples), 4) if self.samples else 0.0,
+        }
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        import YandexAIConnector
+        self.model = FakeModel(args.latency, args.jitter, args.token_rate, args.reply_tokens, args.failure_rate)
+        YandexAIConnector._shared_manager = YandexAIConnector.DialogueManager(pool=FakePool(self.model))
+
+        import BotMain
+        self.bot_main = BotMain
+        BotMain.stream_replies = args.stream
+        BotMain.stream_edit_interval = args.edit_interval
+        self.bot = FakeBot(args.telegram_latency)
+        self.application = FakeApplication()
+        self.characters = BotMain.registry.names()
+
+        # Отмечаем завершение обработки каждой реплики, чтобы измерить полную задержку
+        self._done: Dict[int, asyncio.Event] = {}
+        self._failed = 0
+        handler = BotMain.scheduler.handler
+
+        async def tracked(chat_id, text, context):
+            try:
+                await handler(chat_id, text, context)
+            finally:
+                self._done[chat_id].set()
+
+        BotMain.scheduler.handler = tracked
+
+    def context(self, args: Optional[List[str]] = None):
+        return make_context(self.bot, self.application, args)
+
+    async def _open_chat(self, chat_id: int):
+        await self.bot_main.start(make_update(chat_id), self.context())
+        character = self.characters[chat_id % len(self.characters)]
+        await self.bot_main.button_handler(make_callback_update(chat_id, character), self.context())
+
+    async def scenario_buttons(self) -> Dict[str, float]:
+        """/start и выбор персонажа кнопкой для каждого чата"""
+        latencies = []
+
+        async def one(chat_id):
+            started = time.perf_counter()
+            await self._open_chat(chat_id)
+            latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(chat_id) for chat_id in range(self.args.chats)))
+        return summarize(latencies, 0, time.perf_counter() - started)
+
+    async def scenario_messages(self) -> Dict[str, float]:
+        """Каждый чат последовательно отправляет несколько сообщений, чаты работают параллельно"""
+        latencies = []
+        errors = 0
+
+        async def one(chat_id):
+            nonlocal errors
+            for i in range(self.args.messages):
+                event = self._done[chat_id] = asyncio.Event()
+                started = time.perf_counter()
+                dialogue = self.bot_main.dialogues.get(chat_id)
+                turns = len(dialogue.character.interactions)
+                await self.bot_main.handle_message(make_update(chat_id, f"Сообщение {i}"), self.context())
+                try:
+                    await asyncio.wait_for(event.wait(), self.args.timeout)
+                except asyncio.TimeoutError:
+                    errors += 1  # Сообщение отклонено или зависло
+                    continue
+                latencies.append(time.perf_counter() - started)
+                if len(dialogue.character.interactions) < turns + 2:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(chat_id) for chat_id in range(self.args.chats)))
+        return summarize(latencies, errors, time.perf_counter() - started)
+
+    async def scenario_conversation(self) -> Dict[str, float]:
+        """Несколько параллельных /conversation между персонажами"""
+        latencies = []
+        names = self.characters[:self.args.conversation_size]
+
+        async def one(chat_id):
+            started = time.perf_counter()
+            await self.bot_main.conversation(make_update(chat_id), self.context(list(names)))
+            latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        offset = self.args.chats
+        await asyncio.gather(*(one(offset + i) for i in range(self.args.conversations)))
+        return summarize(latencies, 0, time.perf_counter() - started)
+
+    async def scenario_to_all(self) -> Dict[str, float]:
+        """Рассылка /to_all по всем открытым чатам"""
+        self.bot_main.broadcast_state_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_broadcast.json')
+        self.bot_main.admin_ids.add(0)  # Рассылку запускает администратор
+        started = time.perf_counter()
+        await self.bot_main.to_all(make_update(0), self.context(['Тестовая', 'рассылка']))
+        await asyncio.gather(*self.application.tasks)
+        duration = time.perf_counter() - started
+        job = self.bot_main.broadcast_job
+        if os.path.exists(self.bot_main.broadcast_state_path):
+            os.remove(self.bot_main.broadcast_state_path)
+        result = summarize([duration], len(job.failed), duration)
+        result['throughput'] = round(job.sent / duration, 2) if duration > 0 else 0.0
+        result['count'] = job.sent
+        return result
+
+    async def memory_per_session(self) -> float:
+        """Память на одну сессию после /start, выбора персонажа и одной реплики"""
+        count = self.args.memory_sessions
+        offset = 10 ** 6
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for chat_id in range(offset, offset + count):
+            await self._open_chat(chat_id)
+            self._done[chat_id] = asyncio.Event()
+            await self.bot_main.handle_message(make_update(chat_id, "Привет"), self.context())
+        await asyncio.gather(*(self._done[chat_id].wait() for chat_id in range(offset, offset + count)))
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+        return round(allocated / count, 1)
+
+    async def run(self) -> Dict:
+        monitor = LoopLagMonitor()
+        monitor.start()
+        results = {
+            'label': self.args.label,
+            'timestamp': time.time(),
+            'python': sys.version.split()[0],
+            'settings': {key: value for key, value in vars(self.args).items() if key not in ('output', 'compare')},
+            'scenarios': {}
+        }
+        results['scenarios']['button_handler'] = await self.scenario_buttons()
+        results['scenarios']['handle_message'] = await self.scenario_messages()
+        if self.args.conversations:
+            results['scenarios']['conversation'] = await self.scenario_conversation()
+        results['scenarios']['to_all'] = await self.scenario_to_all()
+        results['event_loop_lag'] = await monitor.stop()
+        results['memory_per_session_bytes'] = await self.memory_per_session()
+        results['model_calls'] = self.model.calls
+        results['telegram_calls'] = {'send_message': self.bot.sent, 'edit_message_text': self.bot.edited}
+        await self.bot_main.scheduler.close()
+        return results
+
+
+def compare(old_path: str, new_path: str):
+    """Печатает изменение ключевых метрик между двумя результатами"""
+    with open(old_path, 'r', encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, 'r', encoding='utf-8') as f:
+        new = json.load(f)
+
+    def line(name, a, b):
+        change = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+        print(f"{name:45} {a:>12} {b:>12} {change:>9}")
+
+    for scenario, metrics in new['scenarios'].items():
+        for key in ('throughput', 'p50', 'p95', 'p99'):
+            if scenario in old['scenarios']:
+                line(f"{scenario}.{key}", old['scenarios'][scenario][key], metrics[key])
+    line('event_loop_lag.p99', old['event_loop_lag']['p99'], new['event_loop_lag']['p99'])
+    line('memory_per_session_bytes', old['memory_per_session_bytes'], new['memory_per_session_bytes'])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с локальными заглушками YandexGPT и Telegram")
+    parser.add_argument('--chats', type=int, default=100, help="Число одновременных чатов")
+    parser.add_argument('--messages', type=int, default=3, help="Сообщений от каждого чата")
+    parser.add_argument('--conversations', type=int, default=2, help="Число параллельных /conversation (0 - пропустить)")
+    parser.add_argument('--conversation-size', type=int, default=2, help="Персонажей в /conversation")
+    parser.add_argument('--memory-sessions', type=int, default=200, help="Сессий для замера памяти")
+    parser.add_argument('--latency', type=float, default=0.5, help="Задержка модели до первого токена, с")
+    parser.add_argument('--jitter', type=float, default=0.2, help="Разброс задержки модели, с")
+    parser.add_argument('--token-rate', type=float, default=200, help="Скорость генерации, токенов в секунду")
+    parser.add_argument('--reply-tokens', type=int, default=60, help="Длина ответа модели в токенах")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="Доля запросов к модели, завершающихся ошибкой")
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help="Задержка ответа Bot API, с")
+    parser.add_argument('--stream', type=int, default=1, help="Потоковые ответы (1/0)")
+    parser.add_argument('--edit-interval', type=float, default=0.2, help="Интервал правок при потоковом ответе, с")
+    parser.add_argument('--timeout', type=float, default=60, help="Сколько ждать ответа на сообщение, с")
+    parser.add_argument('--label', default='', help="Метка прогона (например, версия)")
+    parser.add_argument('--output', help="Файл для результатов в JSON (по умолчанию stdout)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="Сравнить два файла результатов")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    args.stream = bool(args.stream)
+    results = asyncio.run(Benchmark(args).run())
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,64 @@
 import os
 import asyncio
-import json
+import random
+import time
+from typing import List
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters
-from YandexAIConnector import DialogueManager
+from YandexAIConnector import get_dialogue_manager, startup as llm_startup, shutdown as llm_shutdown
 from CharLogic import Character
+from CharRegistry import CharacterRegistry
+from SessionStore import SessionStore, SqliteBackend
+from DialogueJournal import DialogueJournal
+from Broadcast import BroadcastJob, TokenBucket
+from Conversation import Conversation
+from Scheduler import ChatScheduler, QUEUED, REJECTED
+import Metrics
+from Metrics import timed, errors_total
 from prompts import *
 
 load_dotenv()
 script_dir = os.path.dirname(os.path.abspath(__file__))
 config_path = os.path.join(script_dir, 'CharConfig.json')
+registry = CharacterRegistry(config_path)  # Кэш шаблонов персонажей
+stream_replies = os.getenv('STREAM_REPLIES', '1') == '1'  # Показывать ответ по мере генерации
+stream_edit_interval = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))  # Минимальный интервал между правками сообщения
+# Общий для всех чатов лимит запросов потоковых ответов (лимит Telegram около 30 запросов в секунду на бота);
+# запас в полсекунды: даже со всплеском за любую секунду уходит не больше 1.5 * STREAM_EDIT_RATE запросов
+stream_edit_rate = float(os.getenv('STREAM_EDIT_RATE', '20'))
+stream_limiter = TokenBucket(stream_edit_rate, capacity=max(1.0, stream_edit_rate / 2))
+admin_ids = {int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip()}  # Чаты администраторов
+journal_dir = os.getenv('JOURNAL_DIR')  # Каталог журналов диалогов (если не задан, журналы не ведутся)
 
 class Dialogue:
     def __init__(self, chat_id):
         self.chat_id = chat_id
         self.character = None  # Объект Character
+        self.character_key = None  # Ключ персонажа в конфигурации
         self.current_action = None
-        self.dialogue_manager = DialogueManager()  # Создаем менеджер диалогов
+        self.dialogue_manager = get_dialogue_manager()  # Общий менеджер диалогов
 
-    def create_character(self, character_name: str):
-        """Создает объект персонажа по его имени"""
+    def create_character(self, character_name: str, resume: bool = False):
+        """Создает объект персонажа по его имени (при resume история продолжается из журнала)"""
         try:
-            CHARACTERS = json.load(open(config_path, "r", encoding='utf-8'))  # Загружаем конфигурацию персонажей
-            if character_name in CHARACTERS:
-                config = CHARACTERS[character_name]
-                self.character = Character(
+            template = registry.get(character_name)
+            if template is not None:
+                self.character = Character.from_template(
                     user=str(self.chat_id),
-                    name=config["name"],
-                    description=config["description"],
-                    start_line=config["start_line"],
-                    snippets=config["snippets"],
-                    greetings=config["greetings"],
+                    template=template,
                     dialogue_manager=self.dialogue_manager
                 )
+                self.character_key = character_name
+                if journal_dir:
+                    journal = DialogueJournal(
+                        os.path.join(journal_dir, str(self.chat_id)),
+                        compact_every=int(os.getenv('JOURNAL_COMPACT_EVERY', '200'))
+                    )
+                    tail = os.getenv('JOURNAL_TAIL')
+                    self.character.attach_journal(journal, resume=resume, tail=int(tail) if tail else None)
                 return True
             else:
                 print(f"{self.chat_id} попытался выбрать персонажа {character_name} а его нет")
@@ -43,6 +68,24 @@ class Dialogue:
             return False
         
 
+    def to_dict(self) -> dict:
+        """Сериализует диалог для хранилища сессий"""
+        return {
+            'chat_id': self.chat_id,
+            'current_action': self.current_action,
+            'character_key': self.character_key if self.character else None,
+            'character_state': self.character.get_state() if self.character else None
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Dialogue':
+        """Восстанавливает диалог из хранилища сессий"""
+        dialogue = cls(data['chat_id'])
+        dialogue.current_action = data.get('current_action')
+        if data.get('character_key') and dialogue.create_character(data['character_key'], resume=True):
+            dialogue.character.set_state(data['character_state'])
+        return dialogue
+
     async def send_message(self, context: ContextTypes.DEFAULT_TYPE, text: str, buttons: list = None, action: str = None):
         """Отправляет сообщение с кнопками и запоминает текущую логику"""
         reply_markup = None
@@ -53,8 +96,37 @@ class Dialogue:
         self.current_action = action
         await context.bot.send_message(chat_id=self.chat_id, text=text, reply_markup=reply_markup)
 
-# Словарь для хранения активных диалогов
-dialogues = {}
+if journal_dir:
+    os.makedirs(journal_dir, exist_ok=True)
+
+def create_session_store() -> SessionStore:
+    """Создает хранилище сессий по настройкам окружения"""
+    backend = None
+    if os.getenv('SESSION_BACKEND', 'sqlite') == 'sqlite':
+        backend = SqliteBackend(os.getenv('SESSION_DB_PATH', os.path.join(script_dir, 'sessions.db')))
+    return SessionStore(
+        loader=Dialogue.from_dict,
+        backend=backend,
+        max_sessions=int(os.getenv('SESSION_MAX', '10000')),
+        idle_ttl=float(os.getenv('SESSION_IDLE_TTL', '3600'))
+    )
+
+# Хранилище активных диалогов (LRU в памяти, выгруженные сессии лежат в SQLite)
+dialogues = create_session_store()
+
+# Текущая фоновая рассылка /to_all (одновременно выполняется не более одной)
+broadcast_state_path = os.getenv('BROADCAST_STATE_PATH', os.path.join(script_dir, 'broadcast.json'))
+broadcast_job = None
+
+def broadcast_running() -> bool:
+    return broadcast_job is not None and broadcast_job.running
+
+def start_broadcast(application: Application, job: BroadcastJob):
+    """Запускает рассылку в фоне, не занимая обработчик команды"""
+    global broadcast_job
+    broadcast_job = job
+    job.running = True
+    application.create_task(job.run())
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -72,12 +144,11 @@ async def choice_character(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     # Убедимся, что диалог существует (на случай, если эта функция вызвана не через /start)
-    if chat_id not in dialogues:
+    if dialogues.get(chat_id) is None:
         dialogues[chat_id] = Dialogue(chat_id)
 
     try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            characters_config = json.load(f)
+        characters = registry.names()
     except Exception as e:
         await context.bot.send_message(
             chat_id=chat_id,
@@ -86,7 +157,6 @@ async def choice_character(update: Update, context: ContextTypes.DEFAULT_TYPE):
         print(f"Ошибка {e}")
         return
 
-    characters = list(characters_config.keys())
     await dialogues[chat_id].send_message(
         context,
         "Выберите персонажа:",
@@ -100,8 +170,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     chat_id = query.message.chat.id
-    if chat_id in dialogues:
-        dialogue = dialogues[chat_id]
+    dialogue = dialogues.get(chat_id)
+    if dialogue is not None:
         selected_button = query.data
 
         if dialogue.current_action == "choose_character":
@@ -113,21 +183,186 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 await query.edit_message_text(text="Произошла ошибка при выборе персонажа")
 
+def split_message(text: str, limit: int = MessageLimit.MAX_TEXT_LENGTH) -> List[str]:
+    """
+    Делит текст на части не длиннее лимита Telegram, по возможности по переводу строки или пробелу.
+    Граница части выбирается только по уже известному тексту, поэтому при дописывании
+    потокового ответа готовые части не меняются.
+    """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit + 1)
+        if cut <= 0:
+            cut = text.rfind(' ', 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n ')
+    parts.append(text)
+    return parts
+
+def retry_after_seconds(e: RetryAfter) -> float:
+    return e.retry_after if isinstance(e.retry_after, (int, float)) else e.retry_after.total_seconds()
+
+async def send_streamed_reply(context: ContextTypes.DEFAULT_TYPE, chat_id: int, stream):
+    """
+    Отправляет заглушку и правит ее по мере генерации ответа.
+    Правки идут не чаще stream_edit_interval в чате и в пределах общего stream_limiter:
+    если свободного места в лимите нет, промежуточная правка пропускается, и следующая
+    покажет накопившийся текст. Итоговый текст дожидается места в лимите.
+    Заглушка при исчерпанном лимите не отправляется: ответ придет первой правкой или целиком.
+    Ответ длиннее лимита Telegram продолжается в следующих сообщениях.
+    """
+    message_ids, shown = [], []  # Сообщения ответа и показанный в них текст
+    if stream_limiter.try_acquire():
+        with timed('telegram_send'):
+            message = await context.bot.send_message(chat_id=chat_id, text="…")
+        message_ids.append(message.message_id)
+        shown.append('')
+    latest = ''
+    paused_until = 0.0  # До этого времени промежуточные правки не отправляются (flood control)
+    done = asyncio.Event()
+
+    async def put(index: int, text: str, final: bool) -> bool:
+        """Показывает часть ответа; итоговый текст повторяется после flood control и в крайнем случае отправляется заново"""
+        nonlocal paused_until
+        for _ in range(3 if final else 1):
+            if final:
+                await stream_limiter.acquire()
+            elif time.monotonic() < paused_until or not stream_limiter.try_acquire():
+                return False  # Правка объединится со следующей
+            try:
+                if index < len(message_ids):
+                    with timed('telegram_edit'):
+                        await context.bot.edit_message_text(chat_id=chat_id, message_id=message_ids[index], text=text)
+                else:
+                    with timed('telegram_send'):
+                        sent = await context.bot.send_message(chat_id=chat_id, text=text)
+                    message_ids.append(sent.message_id)
+                    shown.append('')
+                shown[index] = text
+                return True
+            except RetryAfter as e:
+                errors_total.inc(where='telegram_edit')
+                if not final:
+                    # Промежуточная правка не ждет: до конца паузы правки пропускаются
+                    paused_until = time.monotonic() + retry_after_seconds(e)
+                    return False
+                await asyncio.sleep(retry_after_seconds(e))
+            except BadRequest as e:
+                if 'not modified' in str(e).lower():
+                    shown[index] = text
+                    return True
+                errors_total.inc(where='telegram_edit')
+                break
+            except Exception as e:
+                # Сетевые сбои (TimedOut, NetworkError) не должны прерывать показ ответа
+                errors_total.inc(where='telegram_edit')
+                print(f"Не удалось обновить ответ в {chat_id}: {str(e)}")
+                break
+        if not final:
+            return False
+        try:
+            await stream_limiter.acquire()
+            sent = await context.bot.send_message(chat_id=chat_id, text=text)
+        except Exception as e:
+            print(f"Не удалось отправить ответ в {chat_id}: {str(e)}")
+            return False
+        if index < len(message_ids):
+            message_ids[index] = sent.message_id
+        else:
+            message_ids.append(sent.message_id)
+            shown.append('')
+        shown[index] = text
+        return True
+
+    async def show(text: str, final: bool = False) -> bool:
+        for index, part in enumerate(split_message(text)):
+            if index >= len(shown) or shown[index] != part:
+                if not await put(index, part, final):
+                    return False  # Следующие части нельзя показывать раньше этой
+        return True
+
+    async def edit_loop():
+        interval = stream_edit_interval
+        while not done.is_set():
+            try:
+                await asyncio.wait_for(done.wait(), interval)
+            except asyncio.TimeoutError:
+                # После пропущенной правки следующая попытка раньше и в случайный момент,
+                # чтобы чаты не упирались в общий лимит одновременно
+                skipped = latest.strip() and not await show(latest)
+                interval = random.uniform(0, stream_edit_interval) if skipped else stream_edit_interval
+
+    editor = asyncio.create_task(edit_loop())
+    try:
+        async for latest in stream:
+            pass
+    except Exception as e:
+        errors_total.inc(where='handle_message')
+        print(f"Ошибка при потоковой генерации для {chat_id}: {str(e)}")
+        latest = "Произошла ошибка при обработке сообщения. Попробуйте еще раз."
+    finally:
+        done.set()
+        try:
+            await editor
+        except Exception as e:
+            # Сбой промежуточной правки не должен помешать показать итоговый текст
+            print(f"Ошибка при обновлении ответа в {chat_id}: {str(e)}")
+
+    await show(latest or "…", final=True)
+    return latest
+
+async def process_message(chat_id: int, user_message: str, context: ContextTypes.DEFAULT_TYPE):
+    """Генерирует ответ персонажа на реплику (вызывается планировщиком, по одной реплике на чат)"""
+    dialogue = dialogues.get(chat_id)
+    if dialogue is None or not dialogue.character:
+        return
+
+    if stream_replies:
+        await send_streamed_reply(context, chat_id, dialogue.character.stream_user_message_async(user_message))
+        return
+
+    try:
+        # Получаем ответ от персонажа
+        response = await dialogue.character.add_user_message_async(user_message)
+        with timed('telegram_send'):
+            for part in split_message(response):
+                await context.bot.send_message(chat_id=chat_id, text=part)
+    except Exception as e:
+        errors_total.inc(where='handle_message')
+        print(f"Ошибка при обработке сообщения {chat_id}: {str(e)}")
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="Произошла ошибка при обработке сообщения. Попробуйте еще раз."
+        )
+
+# Очередь генераций: сообщения одного чата обрабатываются по порядку, чаты - по кругу
+scheduler = ChatScheduler(
+    process_message,
+    concurrency=int(os.getenv('SCHEDULER_CONCURRENCY', '50')),
+    max_queue=int(os.getenv('SCHEDULER_MAX_QUEUE', '1000'))
+)
+
+Metrics.metrics.gauge('bot_active_sessions', "Сессии в памяти", dialogues.active_count)
+Metrics.metrics.gauge('bot_queued_chats', "Чаты в очереди на генерацию", scheduler.queue_size)
+Metrics.metrics.gauge('bot_in_flight_chats', "Чаты, для которых генерируется ответ", scheduler.in_flight)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений от пользователя"""
     chat_id = update.effective_chat.id
-    if chat_id in dialogues and dialogues[chat_id].character:
-        dialogue = dialogues[chat_id]
-        user_message = update.message.text
-        
-        try:
-            # Получаем ответ от персонажа
-            response = dialogue.character.add_user_message(user_message)
-            await context.bot.send_message(chat_id=chat_id, text=response)
-        except Exception as e:
+    dialogue = dialogues.get(chat_id)
+    if dialogue is not None and dialogue.character:
+        status = scheduler.submit(chat_id, update.message.text, context)
+        if status == QUEUED:
             await context.bot.send_message(
                 chat_id=chat_id,
-                text="Произошла ошибка при обработке сообщения. Попробуйте еще раз."
+                text="Сейчас много запросов, ваше сообщение в очереди. Ответ придет чуть позже."
+            )
+        elif status == REJECTED:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="Бот перегружен. Попробуйте отправить сообщение через минуту."
             )
     else:
         await context.bot.send_message(
@@ -151,8 +386,8 @@ async def conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Загружаем конфигурации персонажей
     try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            characters_config = json.load(f)
+        templates = {char: registry.get(char) for char in context.args}
+        available = registry.names()
     except Exception as e:
         await context.bot.send_message(
             chat_id=chat_id,
@@ -163,32 +398,29 @@ async def conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Проверяем существование всех персонажей
     characters = context.args
     for char in characters:
-        if char not in characters_config:
+        if templates[char] is None:
             await context.bot.send_message(
                 chat_id=chat_id,
-                text=f"Персонаж '{char}' не найден. Доступные персонажи: {', '.join(characters_config.keys())}"
+                text=f"Персонаж '{char}' не найден. Доступные персонажи: {', '.join(available)}"
             )
             return
 
     # Сбрасываем текущий диалог
-    if chat_id in dialogues:
-        dialogues[chat_id].character = None
+    dialogue = dialogues.get(chat_id)
+    if dialogue is not None:
+        dialogue.character = None
 
     # Создаем экземпляры персонажей для диалога
-    dialogue_manager = DialogueManager()
-    char_instances = {}
-    
-    for char_name in characters:
-        config = characters_config[char_name]
-        char_instances[char_name] = Character(
+    dialogue_manager = get_dialogue_manager()
+    # У каждого участника свой экземпляр, даже если персонаж указан несколько раз
+    char_instances = [
+        Character.from_template(
             user="System",
-            name=config["name"],
-            description=config["description"],
-            start_line=config["start_line"],
-            snippets=config["snippets"],
-            greetings=config["greetings"],
+            template=templates[char_name],
             dialogue_manager=dialogue_manager
         )
+        for char_name in characters
+    ]
 
     # Начинаем диалог
     await context.bot.send_message(
@@ -196,30 +428,8 @@ async def conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text="Начинаем диалог между персонажами..."
     )
 
-    # Два круга реплик
-    for round in range(2):
-        for i, current_char in enumerate(characters):
-            # Формируем промпт для текущего персонажа
-            if round == 0 and i == 0:
-                prompt = "Начни диалог с представления себя и обращения к собеседникам"
-            else:
-                # Получаем предыдущего персонажа
-                prev_char = characters[(i - 1) % len(characters)]
-                prompt = f"Ответь на реплику персонажа {prev_char}"
-
-            try:
-                response = char_instances[current_char].add_user_message(prompt)
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"{current_char}: {response}"
-                )
-                await asyncio.sleep(2)  # Пауза между репликами
-            except Exception as e:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"Ошибка при получении ответа от {current_char}."
-                )
-                return
+    if not await Conversation(context.bot, chat_id, char_instances).run():
+        return
 
     await context.bot.send_message(
         chat_id=chat_id,
@@ -232,14 +442,44 @@ async def to_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=update.effective_chat.id, text="API ключ бота не найден!")
         return
 
+    if update.effective_chat.id not in admin_ids:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Команда доступна только администраторам.")
+        return
+
     if not context.args:
         await context.bot.send_message(chat_id=update.effective_chat.id, text="Пожалуйста, укажите текст для отправки.")
         return
 
     message = ' '.join(context.args)
 
-    for chat_id in dialogues.keys():
-        await context.bot.send_message(chat_id=chat_id, text=message)
+    if broadcast_running():
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Рассылка уже идет, дождитесь ее завершения.")
+        return
+
+    job = BroadcastJob(
+        context.bot, message, dialogues.keys(), broadcast_state_path, report_chat_id=update.effective_chat.id
+    )
+    start_broadcast(context.application, job)
+
+async def to_all_resume(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /to_all_resume для продолжения прерванной рассылки"""
+    if 'BOT_TOKEN' not in os.environ:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="API ключ бота не найден!")
+        return
+
+    if update.effective_chat.id not in admin_ids:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Команда доступна только администраторам.")
+        return
+
+    if broadcast_running():
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Рассылка уже идет, дождитесь ее завершения.")
+        return
+
+    job = BroadcastJob.load(context.bot, broadcast_state_path, report_chat_id=update.effective_chat.id)
+    if job is None:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Нет прерванной рассылки.")
+        return
+    start_broadcast(context.application, job)
 
 async def shutdown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /shutdown для завершения работы бота"""
@@ -251,20 +491,66 @@ async def shutdown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.application.stop()
     await context.bot.stop()
 
-def main():
-    token = os.environ.get('BOT_TOKEN')
-    if not token:
-        raise ValueError("Токен бота не найден в переменных среды!")
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /stats: сводка метрик для администраторов"""
+    if update.effective_chat.id not in admin_ids:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="Команда доступна только администраторам.")
+        return
 
-    application = Application.builder().token(token).build()
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=Metrics.summary())
+
+metrics_server = None
+session_sweeper = None
+
+async def sweep_sessions():
+    """Периодически выгружает простаивающие сессии, даже если боту никто не пишет"""
+    while True:
+        await asyncio.sleep(dialogues.sweep_interval)
+        dialogues.sweep()
+
+async def on_startup(application: Application):
+    global metrics_server, session_sweeper
+    await llm_startup()
+    session_sweeper = asyncio.create_task(sweep_sessions())
+    port = int(os.getenv('METRICS_PORT', '9090'))
+    if port:
+        metrics_server = await Metrics.start_http_server(port, os.getenv('METRICS_HOST', '127.0.0.1'))
+
+async def on_shutdown(application: Application):
+    if metrics_server is not None:
+        metrics_server.close()
+    if session_sweeper is not None:
+        session_sweeper.cancel()
+    await scheduler.close()
+    dialogues.close()  # Сохраняем все активные сессии перед остановкой
+    await llm_shutdown()
+
+def build_application(token: str, polling: bool = True) -> Application:
+    """
+    Создает приложение со всеми обработчиками.
+    Без polling обновления передаются в application.update_queue извне (режим webhook).
+    """
+    builder = Application.builder().token(token).concurrent_updates(True).post_init(on_startup).post_shutdown(on_shutdown)
+    if not polling:
+        builder = builder.updater(None)
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("conversation", conversation))  # Новый обработчик
     application.add_handler(CommandHandler("to_all", to_all))  # Новый обработчик
+    application.add_handler(CommandHandler("to_all_resume", to_all_resume))
+    application.add_handler(CommandHandler("stats", stats))
     application.add_handler(CommandHandler("shutdown", shutdown))  # Новый обработчик
     application.add_handler(CallbackQueryHandler(button_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return application
+
+def main():
+    token = os.environ.get('BOT_TOKEN')
+    if not token:
+        raise ValueError("Токен бота не найден в переменных среды!")
 
+    application = build_application(token)
     application.run_polling()
 
 if __name__ == "__main__":
@@ -0,0 +1,207 @@
+from typing import Dict, List, Optional
+from datetime import timedelta
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
+import asyncio
+import json
+import os
+import random
+import time
+from Metrics import errors_total, retries_total
+
+
+class TokenBucket:
+    """Ограничитель частоты: не более rate событий в секунду с запасом capacity"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Ждет, пока появится свободный токен, и забирает его"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def try_acquire(self) -> bool:
+        """Забирает токен без ожидания; False, если токена нет или его уже кто-то ждет"""
+        if self._lock.locked():
+            return False
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def pause(self, seconds: float):
+        """Опустошает корзину так, чтобы следующий токен появился не раньше чем через seconds"""
+        self.tokens = min(self.tokens, -seconds * self.rate + 1)
+
+
+class BroadcastJob:
+    """
+    Фоновая рассылка сообщения по списку чатов.
+
+    Отправляет параллельно несколькими воркерами, соблюдая общий лимит Telegram
+    (около 30 сообщений в секунду) и лимит на чат (1 сообщение в секунду).
+    При RetryAfter приостанавливает всю рассылку на указанное время и повторяет отправку.
+    Прогресс периодически сохраняется в файл, поэтому прерванную рассылку можно продолжить.
+    """
+
+    def __init__(self, bot, text: str, chat_ids: List[int], state_path: str,
+                 report_chat_id: Optional[int] = None, sent: int = 0, failed: Optional[Dict[str, str]] = None):
+        """
+        Args:
+            bot: Объект бота Telegram
+            text (str): Текст рассылки
+            chat_ids (List[int]): Чаты, которым еще нужно отправить сообщение
+            state_path (str): Файл для сохранения прогресса
+            report_chat_id (Optional[int]): Чат администратора для отчетов о прогрессе
+            sent (int): Сколько сообщений уже отправлено (при продолжении)
+            failed (Optional[Dict[str, str]]): Уже известные ошибки по чатам (при продолжении)
+        """
+        self.bot = bot
+        self.text = text
+        self.pending = list(chat_ids)
+        self.state_path = state_path
+        self.report_chat_id = report_chat_id
+        self.sent = sent
+        self.failed: Dict[str, str] = failed or {}
+        self.total = len(self.pending) + sent + len(self.failed)
+
+        self.workers = int(os.getenv('BROADCAST_WORKERS', '20'))
+        self.max_retries = int(os.getenv('BROADCAST_MAX_RETRIES', '5'))
+        self.report_interval = float(os.getenv('BROADCAST_REPORT_INTERVAL', '10'))
+        self.global_limiter = TokenBucket(float(os.getenv('BROADCAST_RATE', '25')))
+        self.chat_interval = 1.0  # Не чаще одного сообщения в секунду в один чат
+        self._last_sent: Dict[int, float] = {}
+        self._done: set = set()
+        self._report_message_id = None
+        self.running = False
+
+    @classmethod
+    def load(cls, bot, state_path: str, report_chat_id: Optional[int] = None) -> Optional['BroadcastJob']:
+        """Загружает прерванную рассылку из файла состояния"""
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if not state['pending']:
+            return None
+        return cls(bot, state['text'], state['pending'], state_path, report_chat_id,
+                   sent=state['sent'], failed=state['failed'])
+
+    def save_state(self):
+        """Сохраняет прогресс рассылки"""
+        state = {
+            'text': self.text,
+            'pending': [chat_id for chat_id in self.pending if chat_id not in self._done],
+            'sent': self.sent,
+            'failed': self.failed
+        }
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_path)
+
+    def progress(self) -> str:
+        return f"Рассылка: отправлено {self.sent} из {self.total}, ошибок {len(self.failed)}"
+
+    async def _send(self, chat_id: int):
+        """Отправляет сообщение в один чат с повторами при перегрузке и сетевых ошибках"""
+        for attempt in range(self.max_retries + 1):
+            wait = self._last_sent.get(chat_id, 0) + self.chat_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self.global_limiter.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=self.text)
+                self._last_sent[chat_id] = time.monotonic()
+                self.sent += 1
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                # Flood control общий для бота, поэтому приостанавливаем всю рассылку
+                self.global_limiter.pause(retry_after)
+                retries_total.inc(where='broadcast')
+                await asyncio.sleep(retry_after)
+            except (Forbidden, BadRequest) as e:
+                # Пользователь заблокировал бота или чат не существует: повтор не поможет
+                self.failed[str(chat_id)] = str(e)
+                return
+            except (TimedOut, NetworkError) as e:
+                if attempt == self.max_retries:
+                    self.failed[str(chat_id)] = str(e)
+                    return
+                retries_total.inc(where='broadcast')
+                await asyncio.sleep(min(30, 2 ** attempt) * (0.5 + random.random()))
+        self.failed[str(chat_id)] = "Превышено число попыток"
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            try:
+                chat_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            failed = len(self.failed)
+            try:
+                await self._send(chat_id)
+            except Exception as e:
+                self.failed[str(chat_id)] = str(e)
+            if len(self.failed) > failed:
+                errors_total.inc(where='broadcast')
+            self._done.add(chat_id)
+
+    async def _report(self, final: bool = False):
+        """Отправляет или обновляет сообщение с прогрессом администратору"""
+        if self.report_chat_id is None:
+            return
+        text = self.progress() + ("\nРассылка завершена." if final else "")
+        try:
+            if self._report_message_id is None:
+                message = await self.bot.send_message(chat_id=self.report_chat_id, text=text)
+                self._report_message_id = message.message_id
+            else:
+                await self.bot.edit_message_text(
+                    chat_id=self.report_chat_id, message_id=self._report_message_id, text=text
+                )
+        except Exception as e:
+            print(f"Ошибка при отправке отчета о рассылке: {str(e)}")
+
+    async def _reporter(self):
+        """Периодически сохраняет прогресс и сообщает его администратору"""
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self.save_state()
+            await self._report()
+
+    async def run(self):
+        """Выполняет рассылку до конца"""
+        self.running = True
+        queue: asyncio.Queue = asyncio.Queue()
+        for chat_id in self.pending:
+            queue.put_nowait(chat_id)
+
+        self.save_state()
+        await self._report()
+        reporter = asyncio.create_task(self._reporter())
+        try:
+            await asyncio.gather(*(self._worker(queue) for _ in range(min(self.workers, len(self.pending)))))
+        finally:
+            reporter.cancel()
+            self.save_state()
+            self.running = False
+        await self._report(final=True)
+        return self.sent, self.failed
@@ -1,12 +1,28 @@
-from typing import List, Dict
+from typing import List, Dict, Optional, AsyncIterator, Tuple
 import json
+import os
 from YandexAIConnector import DialogueManager
+from CharRegistry import CharacterTemplate
+from History import History, HistoryView, Message, make_prefix
+from DialogueJournal import DialogueJournal
+from Metrics import timed, history_messages
 from prompts import *
 
+# Доля бюджета, до которой сокращается история при свертке в краткое содержание.
+# Запас нужен, чтобы не вызывать суммаризацию на каждом ходу.
+KEEP_RATIO = 0.5
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов YandexGPT без обращения к API"""
+    return len(text) // 3 + 1
+
+
 class Character:
     def __init__(self, user: str, name: str, description: str, 
                  start_line: str, snippets: List[Dict[str, str]], 
-                 greetings: str, dialogue_manager: DialogueManager):
+                 greetings: str, dialogue_manager: DialogueManager,
+                 prefix: Optional[Tuple[Message, ...]] = None):
         """
         Инициализация персонажа для диалога.
         
@@ -18,6 +34,7 @@ class Character:
             snippets (List[Dict[str, str]]): Примеры диалогов для обучения
             greetings (str): Приветственная фраза
             dialogue_manager (DialogueManager): Менеджер диалогов для работы с API
+            prefix (Optional[Tuple[Message, ...]]): Готовый общий префикс истории из шаблона
         """
         self.user = user
         self.name = name
@@ -26,17 +43,177 @@ class Character:
         self.snippets = snippets
         self.greetings = greetings
         self.dialogue_manager = dialogue_manager
+        self.prefix = prefix if prefix is not None else make_prefix(start_line, snippets)
         
-        self.interactions = []
+        self.token_budget = int(os.getenv('CONTEXT_TOKEN_BUDGET', '4000'))
+
+        self.journal: Optional[DialogueJournal] = None
+        self.interactions = History(self.prefix)
+        self._turns_base = len(self.prefix)  # Номер первой реплики сессии в журнале
         self.init_dialogue()
+
+    @classmethod
+    def from_template(cls, user: str, template: CharacterTemplate,
+                      dialogue_manager: DialogueManager) -> 'Character':
+        """
+        Создание персонажа из закэшированного шаблона без чтения конфигурации.
+
+        Args:
+            user (str): Имя пользователя
+            template (CharacterTemplate): Шаблон персонажа из реестра
+            dialogue_manager (DialogueManager): Менеджер диалогов для работы с API
+
+        Returns:
+            Character: Новый персонаж
+        """
+        return cls(
+            user=user,
+            name=template.name,
+            description=template.description,
+            start_line=template.start_line,
+            snippets=template.snippets,
+            greetings=template.greetings,
+            dialogue_manager=dialogue_manager,
+            prefix=template.prefix
+        )
         
     def init_dialogue(self):
         """Инициализация начального состояния диалога"""
-        self.interactions = [
-            {'role': 'system', 'text': self.start_line},
-            *self.snippets,
-            {'role': 'assistant', 'text': self.greetings}
+        # Префикс не копируется: все сессии персонажа ссылаются на один кортеж
+        self.interactions = History(self.prefix, [Message.create('assistant', self.greetings)])
+        self._turns_base = self._prefix_len()
+        self.reset_context()
+        if self.journal is not None:
+            self.journal.reset(self.interactions)
+
+    def attach_journal(self, journal: DialogueJournal, resume: bool = True, tail: Optional[int] = None):
+        """
+        Подключает журнал диалога: каждая новая реплика дописывается в него за O(1).
+        При resume история загружается из непустого журнала, иначе журнал начинается с текущей истории.
+
+        Args:
+            journal (DialogueJournal): Журнал диалога
+            resume (bool): Продолжить диалог из журнала
+            tail (Optional[int]): Сколько последних реплик загружать (None - всю историю)
+        """
+        self.journal = journal
+        if not resume or len(journal) == 0:
+            journal.reset(self.interactions)
+            return
+
+        prefix_len = self._prefix_len()
+        if tail is None or len(journal) <= prefix_len + tail:
+            self.interactions = History.from_messages(journal.load(), self.prefix)
+            self._turns_base = self._prefix_len()
+        else:
+            self._load_journal_from(len(journal) - tail)
+        self.reset_context()
+
+    def _load_journal_from(self, start: int):
+        """Загружает из журнала реплики, начиная с номера start; префикс берется из шаблона"""
+        self.interactions = History(self.prefix, map(Message.from_dict, self.journal.tail(len(self.journal) - start)))
+        self._turns_base = start
+
+    def _append(self, message: Dict[str, str]):
+        """Добавляет сообщение в историю и в журнал (проверяется только новое сообщение)"""
+        message = self.interactions.append(message)
+        if self.journal is not None:
+            self.journal.append(message)
+        if message['role'] == 'assistant':
+            history_messages.observe(len(self.interactions))
+
+    def reset_context(self):
+        """Сбрасывает краткое содержание и кэш токенов (после замены истории)"""
+        self.summary = ''
+        self._summarized_upto = self._prefix_len()
+        self._token_counts = []
+
+    def _prefix_len(self) -> int:
+        """Длина неизменяемой части истории: системная строка и примеры диалогов"""
+        return len(self.interactions.prefix)
+
+    def _cacheable(self) -> bool:
+        """
+        Запрос определяется только шаблоном и первой репликой (приветствие и одно сообщение),
+        поэтому повторяется у разных пользователей и его ответ можно брать из кэша.
+        """
+        return not self.summary and len(self.interactions.turns) <= 2
+
+    def _tokens(self, index: int) -> int:
+        """Возвращает число токенов сообщения, подсчитывая каждое сообщение только один раз"""
+        while len(self._token_counts) <= index:
+            self._token_counts.append(estimate_tokens(self.interactions[len(self._token_counts)]['text']))
+        return self._token_counts[index]
+
+    def _plan_context(self) -> int:
+        """
+        Определяет, с какого сообщения начинается окно последних реплик.
+
+        Returns:
+            int: Индекс первого сообщения, которое отправляется модели целиком.
+                 Все реплики между уже свернутыми и этим индексом нужно свернуть в краткое содержание.
+        """
+        prefix_len = self._prefix_len()
+        fixed = sum(self._tokens(i) for i in range(prefix_len)) + estimate_tokens(self.summary)
+        budget = self.token_budget - fixed
+
+        end = len(self.interactions)
+        total = sum(self._tokens(i) for i in range(self._summarized_upto, end))
+        if total <= budget:
+            return self._summarized_upto
+
+        # Оставляем последние реплики в пределах части бюджета, последняя реплика остается всегда
+        start, kept = end - 1, self._tokens(end - 1)
+        while start - 1 >= self._summarized_upto and kept + self._tokens(start - 1) <= budget * KEEP_RATIO:
+            start -= 1
+            kept += self._tokens(start)
+        return start
+
+    def _summary_request(self, start: int) -> List[Dict[str, str]]:
+        """Формирует запрос на обновление краткого содержания репликами до индекса start"""
+        lines = '\n'.join(
+            f"{self.user if msg['role'] == 'user' else self.name}: {msg['text']}"
+            for msg in self.interactions[self._summarized_upto:start]
+        )
+        return [
+            {'role': 'system', 'text': SUMMARY_PROMPT},
+            {'role': 'user', 'text': f"Текущее краткое содержание: {self.summary}\n\nНовые реплики:\n{lines}"}
         ]
+
+    def _build_context(self) -> HistoryView:
+        """Окно истории для модели: префикс, краткое содержание и последние реплики (без копирования)"""
+        extra = ()
+        if self.summary:
+            extra = (Message('system', f"Краткое содержание предыдущей части диалога: {self.summary}"),)
+        return self.interactions.view(self._summarized_upto, extra)
+
+    def get_context(self) -> HistoryView:
+        """
+        Возвращает контекст для модели в пределах бюджета токенов CONTEXT_TOKEN_BUDGET.
+        При переполнении старые реплики сворачиваются в краткое содержание.
+
+        Returns:
+            HistoryView: Сообщения для отправки в модель (окно истории без копирования)
+        """
+        with timed('prompt'):
+            start = self._plan_context()
+        if start > self._summarized_upto:
+            with timed('summary'):
+                self.summary = self.dialogue_manager.get_reply(self._summary_request(start), character=self.name)
+            self._summarized_upto = start
+        with timed('prompt'):
+            return self._build_context()
+
+    async def get_context_async(self) -> HistoryView:
+        """Асинхронный вариант get_context"""
+        with timed('prompt'):
+            start = self._plan_context()
+        if start > self._summarized_upto:
+            with timed('summary'):
+                self.summary = await self.dialogue_manager.get_reply_async(self._summary_request(start), character=self.name)
+            self._summarized_upto = start
+        with timed('prompt'):
+            return self._build_context()
     
     def add_user_message(self, message: str) -> str:
         """
@@ -52,24 +229,90 @@ class Character:
             raise ValueError("Сообщение не может быть пустым")
             
         # Добавляем сообщение пользователя
-        self.interactions.append({
+        self._append({
             'role': 'user',
             'text': message
         })
         
         # Получаем ответ от модели
         response = self.dialogue_manager.get_reply(
-            message_history=self.interactions
+            message_history=self.get_context(),
+            character=self.name,
+            cache=self._cacheable()
         )
         
         # Добавляем ответ в историю
-        self.interactions.append({
+        self._append({
             'role': 'assistant',
             'text': response
         })
         
         return response
-    
+
+    async def add_user_message_async(self, message: str) -> str:
+        """
+        Асинхронное добавление сообщения пользователя и получение ответа.
+        Не блокирует цикл событий на время запроса к модели.
+
+        Args:
+            message (str): Сообщение пользователя
+
+        Returns:
+            str: Ответ персонажа
+        """
+        if not message.strip():
+            raise ValueError("Сообщение не может быть пустым")
+
+        self._append({
+            'role': 'user',
+            'text': message
+        })
+
+        response = await self.dialogue_manager.get_reply_async(
+            message_history=await self.get_context_async(),
+            character=self.name,
+            cache=self._cacheable()
+        )
+
+        self._append({
+            'role': 'assistant',
+            'text': response
+        })
+
+        return response
+
+    async def stream_user_message_async(self, message: str) -> AsyncIterator[str]:
+        """
+        Добавление сообщения пользователя и потоковое получение ответа.
+        Ответ записывается в историю только после завершения генерации.
+
+        Args:
+            message (str): Сообщение пользователя
+
+        Yields:
+            str: Текст ответа, сгенерированный к текущему моменту
+        """
+        if not message.strip():
+            raise ValueError("Сообщение не может быть пустым")
+
+        self._append({
+            'role': 'user',
+            'text': message
+        })
+
+        response = ''
+        async for response in self.dialogue_manager.stream_reply_async(
+            message_history=await self.get_context_async(),
+            character=self.name,
+            cache=self._cacheable()
+        ):
+            yield response
+
+        self._append({
+            'role': 'assistant',
+            'text': response
+        })
+
     def read_interactions(self) -> List[str]:
         """
         Получение истории диалога в читаемом формате.
@@ -95,18 +338,70 @@ class Character:
         if self.name != "":
             # Получаем инструкции и отправляем их в менеджер диалогов
             msg = f"Начать бой с {enemy}.\nУказания для персонажа и какой инвентарь дан для боя: {instructions}"
-            self.interactions.append({'role':'user','text':msg})
-            fight_msg = self.dialogue_manager.get_reply(self.interactions,FIGHT_PROMPT)
-            self.interactions.append({'role':'system','text':fight_msg})
+            self._append({'role':'user','text':msg})
+            fight_msg = self.dialogue_manager.get_reply(self.get_context(),FIGHT_PROMPT,character=self.name,
+                                                        cache=self._cacheable())
+            self._append({'role':'system','text':fight_msg})
             return fight_msg
 
+    async def let_fight_async(self, enemy, instructions):
+        """Асинхронный вариант let_fight"""
+        if self.name != "":
+            msg = f"Начать бой с {enemy}.\nУказания для персонажа и какой инвентарь дан для боя: {instructions}"
+            self._append({'role': 'user', 'text': msg})
+            fight_msg = await self.dialogue_manager.get_reply_async(
+                await self.get_context_async(), FIGHT_PROMPT, character=self.name, cache=self._cacheable()
+            )
+            self._append({'role': 'system', 'text': fight_msg})
+            return fight_msg
+
+
+    def get_state(self) -> Dict:
+        """Состояние диалога для сохранения между перезапусками"""
+        state = {'summary': self.summary}
+        if self.journal is None:
+            # С журналом история уже сохранена на диске
+            state['interactions'] = self.interactions.to_dicts()
+            state['summarized_upto'] = self._summarized_upto
+        else:
+            # Граница краткого содержания как номер записи журнала: не зависит от того, сколько хвоста загружено
+            state['summary_boundary'] = self._turns_base + self._summarized_upto - self._prefix_len()
+        return state
+
+    def set_state(self, state: Dict):
+        """Восстановление состояния диалога, полученного из get_state"""
+        if 'interactions' in state:
+            self.interactions = History.from_messages(state['interactions'], self.prefix)
+            self._turns_base = self._prefix_len()
+        self.reset_context()
+        self.summary = state.get('summary', '')
+        self._summarized_upto = state.get('summarized_upto', self._prefix_len())
+
+        boundary = state.get('summary_boundary')
+        if self.journal is not None and boundary is not None:
+            boundary = min(max(boundary, self._prefix_len()), len(self.journal))
+            if boundary < self._turns_base:
+                # Загруженный хвост начинается позже границы: догружаем реплики, не вошедшие в краткое содержание
+                self._load_journal_from(boundary)
+                self.reset_context()
+                self.summary = state.get('summary', '')
+            self._summarized_upto = self._prefix_len() + boundary - self._turns_base
 
     def save_dialogue(self, filename: str):
-        """Сохранение диалога в JSON файл"""
+        """Экспорт диалога в JSON файл (полная история, в том числе из журнала)"""
+        interactions = self.journal.load() if self.journal is not None else self.interactions.to_dicts()
         with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(self.interactions, f, ensure_ascii=False, indent=2)
+            json.dump(interactions, f, ensure_ascii=False, indent=2)
     
     def load_dialogue(self, filename: str):
-        """Загрузка диалога из JSON файла"""
-        with open(filename, 'r', encoding='utf-8') as f:
-            self.interactions = json.load(f)
\ No newline at end of file
+        """Импорт диалога из JSON файла или из журнала (.jsonl)"""
+        if filename.endswith('.jsonl'):
+            messages = DialogueJournal(filename[:-len('.jsonl')]).load()
+        else:
+            with open(filename, 'r', encoding='utf-8') as f:
+                messages = json.load(f)
+        self.interactions = History.from_messages(messages, self.prefix)
+        self._turns_base = self._prefix_len()
+        self.reset_context()
+        if self.journal is not None:
+            self.journal.reset(self.interactions)
\ No newline at end of file
@@ -0,0 +1,119 @@
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
+import json
+import os
+import time
+from History import Message, ROLES, make_prefix
+
+
+@dataclass(frozen=True)
+class CharacterTemplate:
+    """Неизменяемый шаблон персонажа, разобранный из CharConfig.json"""
+    key: str
+    name: str
+    description: str
+    start_line: str
+    snippets: Tuple[Mapping[str, str], ...]
+    greetings: str
+    prefix: Tuple[Message, ...]  # Общий для всех сессий префикс истории
+
+    @classmethod
+    def from_config(cls, key: str, config: dict) -> 'CharacterTemplate':
+        """
+        Проверяет конфигурацию персонажа и создает шаблон.
+
+        Args:
+            key (str): Ключ персонажа в конфигурации
+            config (dict): Описание персонажа
+
+        Returns:
+            CharacterTemplate: Шаблон персонажа
+        """
+        if not isinstance(config, dict):
+            raise ValueError(f"Персонаж {key}: описание должно быть объектом")
+
+        for field in ('name', 'description', 'start_line', 'greetings'):
+            if not isinstance(config.get(field), str):
+                raise ValueError(f"Персонаж {key}: поле '{field}' должно быть строкой")
+
+        snippets = config.get('snippets', [])
+        if not isinstance(snippets, list):
+            raise ValueError(f"Персонаж {key}: поле 'snippets' должно быть списком")
+        for snippet in snippets:
+            if (not isinstance(snippet, dict) or snippet.get('role') not in ROLES
+                    or not isinstance(snippet.get('text'), str)):
+                raise ValueError(f"Персонаж {key}: некорректный пример диалога {snippet}")
+
+        return cls(
+            key=key,
+            name=config['name'],
+            description=config['description'],
+            start_line=config['start_line'],
+            snippets=tuple(MappingProxyType({'role': s['role'], 'text': s['text']}) for s in snippets),
+            greetings=config['greetings'],
+            prefix=make_prefix(config['start_line'], snippets),
+        )
+
+
+class CharacterRegistry:
+    """
+    Кэш шаблонов персонажей.
+    Файл конфигурации разбирается один раз и перечитывается только при изменении mtime.
+    Если новая версия файла некорректна, продолжает использоваться последняя удачная.
+    """
+
+    def __init__(self, path: str, check_interval: float = 1.0):
+        """
+        Args:
+            path (str): Путь к CharConfig.json
+            check_interval (float): Минимальный интервал между проверками mtime в секундах
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self._templates: Optional[Dict[str, CharacterTemplate]] = None
+        self._mtime: Optional[float] = None
+        self._last_check = 0.0
+
+    def _load(self) -> Dict[str, CharacterTemplate]:
+        """Читает и проверяет файл конфигурации"""
+        with open(self.path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError("Конфигурация персонажей должна быть объектом")
+        return {key: CharacterTemplate.from_config(key, value) for key, value in config.items()}
+
+    def _maybe_reload(self):
+        """Перечитывает конфигурацию, если файл изменился"""
+        now = time.monotonic()
+        if self._templates is not None and now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if self._templates is not None and mtime == self._mtime:
+                return
+            templates = self._load()
+        except Exception as e:
+            if self._templates is None:
+                raise
+            print(f"Ошибка при перезагрузке конфигурации персонажей, используется предыдущая версия: {str(e)}")
+            return
+
+        self._templates = templates
+        self._mtime = mtime
+
+    def get(self, key: str) -> Optional[CharacterTemplate]:
+        """Возвращает шаблон персонажа или None, если его нет"""
+        self._maybe_reload()
+        return self._templates.get(key)
+
+    def names(self) -> List[str]:
+        """Возвращает список ключей доступных персонажей"""
+        self._maybe_reload()
+        return list(self._templates.keys())
+
+    def __contains__(self, key: str) -> bool:
+        self._maybe_reload()
+        return key in self._templates
@@ -0,0 +1,153 @@
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import os
+import random
+import time
+from telegram.constants import ChatAction
+from CharLogic import Character
+from Metrics import timed, errors_total
+from prompts import CONVERSATION_OPENING, CONVERSATION_PARTICIPANTS
+
+# Способы выбора следующего говорящего
+ROUND_ROBIN = 'round_robin'  # По кругу в порядке перечисления
+RANDOM = 'random'            # Случайный собеседник, но не тот же, кто говорил только что
+MENTION = 'mention'          # Тот, к кому обратились по имени в последней реплике, иначе по кругу
+SELECTIONS = (ROUND_ROBIN, RANDOM, MENTION)
+
+_DONE = object()  # Конец разговора в очереди отправки
+
+
+class Conversation:
+    """
+    Разговор нескольких персонажей с общей стенограммой.
+
+    Стенограмма хранится один раз. Каждый персонаж помнит, до какой реплики он ее уже видел,
+    и перед своим ходом получает только новые чужие реплики одним сообщением, поэтому
+    его история (и краткое содержание) наращивается, а не собирается заново.
+    Генерация следующей реплики идет параллельно с отправкой и показом текущей.
+    """
+
+    def __init__(self, bot, chat_id: int, characters: List[Character],
+                 rounds: Optional[int] = None, selection: Optional[str] = None):
+        """
+        Args:
+            bot: Объект бота Telegram
+            chat_id (int): Чат, в который идет разговор
+            characters (List[Character]): Участники; один персонаж может участвовать несколько раз,
+                                          у каждого участника свой экземпляр
+            rounds (Optional[int]): Число кругов (по умолчанию CONVERSATION_ROUNDS)
+            selection (Optional[str]): Способ выбора говорящего (по умолчанию CONVERSATION_SELECTION)
+        """
+        self.bot = bot
+        self.chat_id = chat_id
+        self.characters = characters
+        self.speakers = list(range(len(characters)))
+        self.names = self._display_names(characters)
+        self.rounds = rounds if rounds is not None else int(os.getenv('CONVERSATION_ROUNDS', '2'))
+        self.selection = selection or os.getenv('CONVERSATION_SELECTION', ROUND_ROBIN)
+        if self.selection not in SELECTIONS:
+            raise ValueError(f"Неизвестный способ выбора говорящего: {self.selection}")
+
+        # По умолчанию пауза не дольше 2 с: реплика не задерживается сильнее, чем при последовательной отправке
+        self.typing_speed = float(os.getenv('CONVERSATION_TYPING_SPEED', '30'))  # символов в секунду
+        self.max_pause = float(os.getenv('CONVERSATION_MAX_PAUSE', '2'))
+
+        self.transcript: List[Tuple[int, str]] = []  # (номер участника, реплика)
+        self._seen: Dict[int, int] = {key: 0 for key in self.speakers}
+
+    @staticmethod
+    def _display_names(characters: List[Character]) -> List[str]:
+        """Имена участников; повторяющиеся персонажи различаются номером"""
+        totals: Dict[str, int] = {}
+        for character in characters:
+            totals[character.name] = totals.get(character.name, 0) + 1
+        seen: Dict[str, int] = {}
+        names = []
+        for character in characters:
+            seen[character.name] = seen.get(character.name, 0) + 1
+            names.append(character.name if totals[character.name] == 1 else f"{character.name} {seen[character.name]}")
+        return names
+
+    def _next_speaker(self, turn: int) -> int:
+        """Выбирает, кто говорит на ходу turn"""
+        if not self.transcript or self.selection == ROUND_ROBIN:
+            return self.speakers[turn % len(self.speakers)]
+        last = self.transcript[-1][0]
+        others = [key for key in self.speakers if key != last]
+        if self.selection == MENTION:
+            text = self.transcript[-1][1].lower()
+            for key in others:
+                if self.names[key].lower() in text:
+                    return key
+            return self.speakers[(self.speakers.index(last) + 1) % len(self.speakers)]
+        return random.choice(others)
+
+    def _view(self, speaker: int) -> str:
+        """Новые для персонажа реплики стенограммы (свои реплики уже есть в его истории)"""
+        lines = [
+            f"{self.names[key]}: {text}"
+            for key, text in self.transcript[self._seen[speaker]:]
+            if key != speaker
+        ]
+        if self._seen[speaker] == 0:
+            others = ', '.join(self.names[key] for key in self.speakers if key != speaker)
+            lines.insert(0, CONVERSATION_PARTICIPANTS.format(names=others))
+            if not self.transcript:
+                lines.append(CONVERSATION_OPENING)
+        return '\n'.join(lines)
+
+    async def _generate(self, queue: asyncio.Queue):
+        """Генерирует реплики по очереди и передает их на отправку"""
+        speaker = self.speakers[0]
+        try:
+            for turn in range(self.rounds * len(self.speakers)):
+                speaker = self._next_speaker(turn)
+                response = await self.characters[speaker].add_user_message_async(self._view(speaker))
+                self.transcript.append((speaker, response))
+                self._seen[speaker] = len(self.transcript)
+                await queue.put((speaker, response))
+        except Exception as e:
+            errors_total.inc(where='conversation')
+            print(f"Ошибка в разговоре {self.chat_id}: {str(e)}")
+            await queue.put((speaker, None))
+        await queue.put(_DONE)
+
+    def _pause(self, text: str) -> float:
+        """Сколько персонаж "печатает" реплику"""
+        return min(self.max_pause, len(text) / self.typing_speed)
+
+    async def run(self) -> bool:
+        """
+        Проводит разговор до конца.
+
+        Returns:
+            bool: True, если все реплики были сгенерированы и отправлены
+        """
+        # Генератор опережает отправку не больше чем на одну реплику
+        queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        generator = asyncio.create_task(self._generate(queue))
+        shown_at = time.monotonic()
+        try:
+            while True:
+                item = await queue.get()
+                if item is _DONE:
+                    return True
+                speaker, text = item
+                name = self.names[speaker]
+                if text is None:
+                    await self.bot.send_message(chat_id=self.chat_id, text=f"Ошибка при получении ответа от {name}.")
+                    return False
+
+                # Время на чтение предыдущей реплики и генерацию уже прошло, его не ждем повторно
+                delay = self._pause(text) - (time.monotonic() - shown_at)
+                if delay > 0:
+                    try:
+                        await self.bot.send_chat_action(chat_id=self.chat_id, action=ChatAction.TYPING)
+                    except Exception:
+                        pass  # Индикатор набора необязателен
+                    await asyncio.sleep(delay)
+                with timed('telegram_send'):
+                    await self.bot.send_message(chat_id=self.chat_id, text=f"{name}: {text}")
+                shown_at = time.monotonic()
+        finally:
+            generator.cancel()
@@ -0,0 +1,233 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+import json
+import os
+import threading
+
+# Общий фоновый поток для свертки журналов, чтобы не блокировать цикл событий
+_compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal-compactor')
+
+
+class DialogueJournal:
+    """
+    Журнал диалога с добавлением в конец.
+
+    Состоит из двух файлов:
+        <base>.jsonl          - журнал: одна строка JSON на сообщение, {"n": номер, "role": ..., "text": ...}
+        <base>.snapshot.jsonl - снимок: строка-заголовок {"count": N}, затем N сообщений
+
+    Каждое сообщение дописывается за O(1). Свертка переносит журнал в снимок в фоновом потоке.
+    Записи журнала с номером меньше count снимка уже учтены в снимке и пропускаются,
+    поэтому сбой посреди свертки не приводит к дублированию.
+    """
+
+    def __init__(self, base_path: str, compact_every: int = 200):
+        """
+        Args:
+            base_path (str): Путь к файлам журнала без расширения
+            compact_every (int): Через сколько записей в журнале запускать свертку
+        """
+        self.journal_path = base_path + '.jsonl'
+        self.snapshot_path = base_path + '.snapshot.jsonl'
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._file = None
+        self._compacting = False
+        self._snapshot_count = self._read_snapshot_count()
+        self._truncate_partial_line()
+        # Номер следующей записи - по последней записи, которая читается
+        last = self._read_journal_tail(8)
+        self.count = max(last[-1]['n'] + 1, self._snapshot_count) if last else self._snapshot_count
+
+    def _truncate_partial_line(self, block_size: int = 8192):
+        """
+        Обрезает недописанную последнюю строку журнала после сбоя посреди записи.
+        Иначе следующая запись склеится с обрывком и журнал перестанет читаться.
+        """
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = pos = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+            while pos > 0:
+                step = min(block_size, pos)
+                pos -= step
+                f.seek(pos)
+                newline = f.read(step).rfind(b'\n')
+                if newline != -1:
+                    pos += newline + 1
+                    break
+            f.truncate(pos)
+        print(f"Журнал {self.journal_path}: отброшена недописанная запись ({size - pos} байт)")
+
+    # --- чтение ---
+
+    def _read_snapshot_count(self) -> int:
+        """Читает только заголовок снимка"""
+        if not os.path.exists(self.snapshot_path):
+            return 0
+        with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+            return json.loads(f.readline())['count']
+
+    def _read_snapshot(self) -> List[Dict[str, str]]:
+        if not os.path.exists(self.snapshot_path):
+            return []
+        with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+            f.readline()
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _read_journal(self, limit: Optional[int] = None) -> List[Dict]:
+        """Читает записи журнала (до смещения limit в байтах, если задано)"""
+        if not os.path.exists(self.journal_path):
+            return []
+        with open(self.journal_path, 'rb') as f:
+            data = f.read() if limit is None else f.read(limit)
+        records = []
+        for line in data.decode('utf-8', errors='replace').splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass  # Поврежденная строка после сбоя
+        return records
+
+    def _read_journal_tail(self, n: int, block_size: int = 8192) -> List[Dict]:
+        """Читает последние n записей журнала, не читая файл целиком"""
+        if n <= 0 or not os.path.exists(self.journal_path):
+            return []
+        with open(self.journal_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            data = b''
+            while pos > 0 and data.count(b'\n') <= n:
+                step = min(block_size, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+        lines = [line for line in data.splitlines() if line.strip()]
+        if pos > 0:
+            lines = lines[1:]  # Первая строка блока может быть обрезана
+        records = []
+        for line in lines[-n:]:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass  # Недописанная последняя строка после сбоя
+        return records
+
+    @staticmethod
+    def _strip(record: Dict) -> Dict[str, str]:
+        return {'role': record['role'], 'text': record['text']}
+
+    def load(self) -> List[Dict[str, str]]:
+        """Загружает всю историю: снимок и журнал"""
+        messages = self._read_snapshot()
+        messages.extend(self._strip(r) for r in self._read_journal() if r['n'] >= len(messages))
+        return messages
+
+    def tail(self, n: int) -> List[Dict[str, str]]:
+        """
+        Загружает только последние n сообщений.
+
+        Args:
+            n (int): Число сообщений
+
+        Returns:
+            List[Dict[str, str]]: Последние сообщения в хронологическом порядке
+        """
+        records = [r for r in self._read_journal_tail(n) if r['n'] >= self._snapshot_count]
+        messages = [self._strip(r) for r in records]
+        if len(messages) < n and self._snapshot_count:
+            messages = self._read_snapshot()[-(n - len(messages)):] + messages
+        return messages
+
+    def __len__(self) -> int:
+        return self.count
+
+    # --- запись ---
+
+    def append(self, message: Dict[str, str]):
+        """Дописывает сообщение в конец журнала"""
+        line = json.dumps({'n': self.count, 'role': message['role'], 'text': message['text']}, ensure_ascii=False)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.journal_path, 'a', encoding='utf-8')
+            self._file.write(line + '\n')
+            self._file.flush()
+            self.count += 1
+        if self.count - self._snapshot_count >= self.compact_every:
+            self.compact_in_background()
+
+    def reset(self, messages: List[Dict[str, str]]):
+        """Полностью заменяет историю (используется при импорте и начале нового диалога)"""
+        with self._lock:
+            self._write_snapshot(messages)
+            self._close_file()
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            self._snapshot_count = self.count = len(messages)
+
+    def _write_snapshot(self, messages: List[Dict[str, str]]):
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'count': len(messages)}) + '\n')
+            for message in messages:
+                f.write(json.dumps(self._strip(message), ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def compact(self):
+        """Переносит накопленный журнал в снимок"""
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+            offset = os.path.getsize(self.journal_path) if os.path.exists(self.journal_path) else 0
+
+        # Долгая часть выполняется без блокировки: журнал до offset уже не меняется
+        messages = self._read_snapshot()
+        messages.extend(self._strip(r) for r in self._read_journal(offset) if r['n'] >= len(messages))
+        self._write_snapshot(messages)
+
+        with self._lock:
+            # Записи, добавленные во время свертки, переносим в новый журнал
+            self._close_file()
+            rest = b''
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, 'rb') as f:
+                    f.seek(offset)
+                    rest = f.read()
+            tmp_path = self.journal_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(rest)
+            os.replace(tmp_path, self.journal_path)
+            self._snapshot_count = len(messages)
+
+    def compact_in_background(self):
+        """Запускает свертку в фоновом потоке, если она еще не идет"""
+        if self._compacting:
+            return
+        self._compacting = True
+
+        def run():
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"Ошибка при свертке журнала {self.journal_path}: {str(e)}")
+            finally:
+                self._compacting = False
+
+        _compactor.submit(run)
+
+    def close(self):
+        with self._lock:
+            self._close_file()
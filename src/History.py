@@ -0,0 +1,170 @@
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Sequence, Tuple, Union
+import sys
+
+ROLES = ('user', 'assistant', 'system')
+
+
+class Message(NamedTuple):
+    """
+    Неизменяемое сообщение диалога.
+    Занимает заметно меньше памяти, чем dict, и поддерживает прежний доступ message['role'].
+    """
+    role: str
+    text: str
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    @classmethod
+    def create(cls, role: str, text: str) -> 'Message':
+        """Проверяет и создает сообщение; роль интернируется, чтобы не хранить копии строк"""
+        if role not in ROLES or not isinstance(text, str):
+            raise ValueError("Некорректный формат сообщения")
+        return cls(sys.intern(role), text)
+
+    @classmethod
+    def from_dict(cls, message: Union[Dict[str, str], 'Message']) -> 'Message':
+        if isinstance(message, Message):
+            return message
+        if not isinstance(message, dict) or 'role' not in message or 'text' not in message:
+            raise ValueError("Некорректный формат сообщения")
+        return cls.create(message['role'], message['text'])
+
+    def as_dict(self) -> Dict[str, str]:
+        return {'role': self.role, 'text': self.text}
+
+
+class Prefix(tuple):
+    """
+    Неизменяемый префикс истории.
+    Словари сообщений для SDK строятся при первом запросе и разделяются всеми сессиями шаблона.
+    """
+
+    def dicts(self) -> Tuple[Dict[str, str], ...]:
+        cached = self.__dict__.get('_dicts')
+        if cached is None:
+            cached = self.__dict__['_dicts'] = tuple(message.as_dict() for message in self)
+        return cached
+
+
+def make_prefix(start_line: str, snippets: Iterable[Dict[str, str]]) -> Tuple[Message, ...]:
+    """Собирает неизменяемый префикс персонажа: системная строка и примеры диалогов"""
+    return Prefix((Message.create('system', start_line), *(Message.create(s['role'], s['text']) for s in snippets)))
+
+
+def _prefix_dicts(prefix: Tuple[Message, ...]) -> Iterable[Dict[str, str]]:
+    if isinstance(prefix, Prefix):
+        return prefix.dicts()
+    return (message.as_dict() for message in prefix)
+
+
+class History(Sequence):
+    """
+    История диалога: общий неизменяемый префикс шаблона персонажа и реплики сессии.
+
+    Префикс (системная строка и примеры диалогов) хранится в шаблоне в одном экземпляре
+    и разделяется всеми сессиями персонажа. Проверяются только добавляемые сообщения.
+    """
+
+    __slots__ = ('prefix', 'turns')
+
+    def __init__(self, prefix: Tuple[Message, ...], turns: Iterable[Message] = ()):
+        self.prefix = prefix
+        self.turns: List[Message] = list(turns)
+
+    @classmethod
+    def from_messages(cls, messages: Iterable[Union[Dict[str, str], Message]],
+                      prefix: Tuple[Message, ...]) -> 'History':
+        """
+        Создает историю из списка сообщений (например, импортированного из файла).
+        Если начало списка совпадает с префиксом шаблона, используется общий префикс.
+        """
+        messages = [Message.from_dict(m) for m in messages]
+        head = Prefix(messages[:len(prefix)])
+        return cls(prefix if head == prefix else head, messages[len(prefix):])
+
+    def append(self, message: Union[Dict[str, str], Message]) -> Message:
+        message = Message.from_dict(message)
+        self.turns.append(message)
+        return message
+
+    def __len__(self) -> int:
+        return len(self.prefix) + len(self.turns)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return list(self)[index]
+            n = len(self.prefix)
+            return list(self.prefix[start:stop]) + self.turns[max(0, start - n):max(0, stop - n)]
+        if index < 0:
+            index += len(self)
+        if index < len(self.prefix):
+            return self.prefix[index]
+        return self.turns[index - len(self.prefix)]
+
+    def __iter__(self) -> Iterator[Message]:
+        yield from self.prefix
+        yield from self.turns
+
+    def to_dicts(self) -> List[Dict[str, str]]:
+        """Полная история в виде списка словарей (для экспорта и сохранения)"""
+        return [message.as_dict() for message in self]
+
+    def iter_dicts(self) -> Iterator[Dict[str, str]]:
+        """Сообщения для SDK; словари префикса берутся готовыми"""
+        return chain(_prefix_dicts(self.prefix), (message.as_dict() for message in self.turns))
+
+    def view(self, start: int, extra: Tuple[Message, ...] = ()) -> 'HistoryView':
+        """
+        Контекст для модели без копирования истории: префикс, дополнительные сообщения
+        (например, краткое содержание) и реплики, начиная с индекса start всей истории.
+        """
+        return HistoryView(self.prefix, extra, self.turns, max(0, start - len(self.prefix)))
+
+
+class HistoryView(Sequence):
+    """
+    Неизменяемое окно истории для одного запроса к модели.
+    Хранит только ссылки и границы, поэтому создается за O(1); конец окна фиксируется при создании,
+    и реплики, добавленные позже, в запрос не попадают. Проходить окно можно несколько раз (повторы запроса).
+    """
+
+    __slots__ = ('prefix', 'extra', 'turns', 'start', 'stop')
+
+    def __init__(self, prefix: Tuple[Message, ...], extra: Tuple[Message, ...], turns: List[Message], start: int):
+        self.prefix = prefix
+        self.extra = extra
+        self.turns = turns
+        self.start = start
+        self.stop = len(turns)
+
+    def _window(self) -> Iterator[Message]:
+        return map(self.turns.__getitem__, range(self.start, self.stop))
+
+    def __len__(self) -> int:
+        return len(self.prefix) + len(self.extra) + self.stop - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        for part in (self.prefix, self.extra):
+            if index < len(part):
+                return part[index]
+            index -= len(part)
+        return self.turns[self.start + index]
+
+    def __iter__(self) -> Iterator[Message]:
+        return chain(self.prefix, self.extra, self._window())
+
+    def iter_dicts(self) -> Iterator[Dict[str, str]]:
+        """Сообщения для SDK; словари префикса берутся готовыми"""
+        return chain(_prefix_dicts(self.prefix), (message.as_dict() for message in chain(self.extra, self._window())))
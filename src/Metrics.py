@@ -0,0 +1,235 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import time
+
+# Границы корзин гистограмм по умолчанию (секунды)
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (5, 10, 20, 50, 100, 200, 500, 1000)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in items) + '}'
+
+
+class Counter:
+    """Монотонно растущий счетчик с метками"""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self.values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_format_labels(key)} {value}" for key, value in self.values.items())
+        return lines
+
+
+class Gauge:
+    """Текущее значение, вычисляемое при чтении"""
+
+    def __init__(self, name: str, help_text: str, func: Callable[[], float]):
+        self.name = name
+        self.help = help_text
+        self.func = func
+
+    def value(self) -> float:
+        try:
+            return self.func()
+        except Exception:
+            return float('nan')
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.value()}"]
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: запись - один bisect и два сложения"""
+
+    def __init__(self, name: str, help_text: str, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.series: Dict[LabelKey, List] = {}  # метки -> [счетчики корзин, сумма, количество]
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def quantile(self, q: float, **labels) -> float:
+        """Оценка квантиля по корзинам: линейная интерполяция внутри корзины, как histogram_quantile в Prometheus"""
+        series = self.series.get(_label_key(labels))
+        if not series or not series[2]:
+            return 0.0
+        target, seen, lower = q * series[2], 0, 0.0
+        for bound, count in zip(self.buckets, series[0]):
+            if count and seen + count >= target:
+                return lower + (bound - lower) * (target - seen) / count
+            seen += count
+            lower = bound
+        return lower  # Квантиль в корзине +Inf: верхней границы нет, берем последнюю конечную
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else str(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Набор метрик процесса с выводом в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        if name not in self._metrics:
+            self._metrics[name] = Counter(name, help_text)
+        return self._metrics[name]
+
+    def histogram(self, name: str, help_text: str, buckets=TIME_BUCKETS) -> Histogram:
+        if name not in self._metrics:
+            self._metrics[name] = Histogram(name, help_text, buckets)
+        return self._metrics[name]
+
+    def gauge(self, name: str, help_text: str, func: Callable[[], float]) -> Gauge:
+        self._metrics[name] = Gauge(name, help_text, func)
+        return self._metrics[name]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+stage_seconds = metrics.histogram('bot_stage_seconds', "Длительность этапов обработки запроса")
+tokens_total = metrics.counter('bot_tokens_total', "Токены YandexGPT по персонажам")
+errors_total = metrics.counter('bot_errors_total', "Ошибки по месту возникновения")
+retries_total = metrics.counter('bot_retries_total', "Повторные попытки запросов")
+hedges_total = metrics.counter('bot_llm_hedges_total', "Дублирующие запросы к YandexGPT и их исход")
+fallbacks_total = metrics.counter('bot_llm_fallbacks_total', "Запросы, отправленные в резервную модель")
+cache_total = metrics.counter('bot_cache_total', "Обращения к кэшу ответов: попадания и промахи")
+history_messages = metrics.histogram('bot_history_messages', "Размер истории диалога в сообщениях", SIZE_BUCKETS)
+
+
+@contextmanager
+def timed(stage: str, **labels) -> Iterator[None]:
+    """Замеряет длительность блока и записывает ее в bot_stage_seconds"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage=stage, **labels)
+
+
+# Счетчик токенов текущей задачи asyncio (см. track_usage)
+_usage_scope: ContextVar[Optional[Dict[str, int]]] = ContextVar('usage_scope', default=None)
+
+
+@contextmanager
+def track_usage() -> Iterator[Dict[str, int]]:
+    """
+    Дополнительно считает токены всех запросов внутри блока (в пределах текущей задачи asyncio).
+    Нужен, чтобы узнать расход отдельного диалога, когда параллельно идут другие.
+    """
+    usage = {'prompt': 0, 'completion': 0}
+    token = _usage_scope.set(usage)
+    try:
+        yield usage
+    finally:
+        _usage_scope.reset(token)
+
+
+def record_usage(character: Optional[str], usage):
+    """Учитывает токены запроса и ответа из результата YandexGPT"""
+    if usage is None:
+        return
+    character = character or 'unknown'
+    tokens_total.inc(usage.input_text_tokens, character=character, kind='prompt')
+    tokens_total.inc(usage.completion_tokens, character=character, kind='completion')
+    scope = _usage_scope.get()
+    if scope is not None:
+        scope['prompt'] += int(usage.input_text_tokens)
+        scope['completion'] += int(usage.completion_tokens)
+
+
+def summary() -> str:
+    """Краткая сводка для команды /stats"""
+    lines = []
+    for metric in metrics._metrics.values():
+        if isinstance(metric, Gauge):
+            lines.append(f"{metric.name}: {metric.value():g}")
+    for key in sorted(stage_seconds.series):
+        labels = dict(key)
+        count = stage_seconds.series[key][2]
+        lines.append(
+            f"{labels.get('stage')}: n={count}, p50≈{stage_seconds.quantile(0.5, **labels):.3g}с, "
+            f"p95≈{stage_seconds.quantile(0.95, **labels):.3g}с"
+        )
+    prompt = sum(v for k, v in tokens_total.values.items() if ('kind', 'prompt') in k)
+    completion = sum(v for k, v in tokens_total.values.items() if ('kind', 'completion') in k)
+    lines.append(f"Токены: запрос {prompt:g}, ответ {completion:g}")
+    lines.append(f"Ошибки: {errors_total.total():g}, повторы: {retries_total.total():g}")
+    lines.append(f"Дублирующие запросы: {hedges_total.values.get((('outcome', 'sent'),), 0):g}, "
+                 f"резервная модель: {fallbacks_total.total():g}")
+    if cache_total.values:
+        hits = cache_total.values.get((('result', 'hit'),), 0)
+        lines.append(f"Кэш ответов: попаданий {hits:g} из {cache_total.total():g}")
+    return '\n'.join(lines)
+
+
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # Заголовки запроса не нужны
+        path = request_line.split()[1].decode() if len(request_line.split()) > 1 else '/'
+        if path == '/metrics':
+            status, body = '200 OK', metrics.render().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_http_server(port: int, host: str = '127.0.0.1') -> asyncio.AbstractServer:
+    """Запускает HTTP сервер с метриками по адресу http://host:port/metrics"""
+    return await asyncio.start_server(_handle_http, host, port)
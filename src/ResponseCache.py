@@ -0,0 +1,178 @@
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import time
+from Metrics import metrics, cache_total
+
+
+def normalize_text(text: str) -> str:
+    """Нормализует текст сообщения: пробелы и переводы строк не должны менять ключ"""
+    return ' '.join(text.split())
+
+
+class SqliteCacheTier:
+    """Дисковый уровень кэша ответов в базе SQLite"""
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, variants TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.conn.commit()
+        self._writes = 0
+
+    def load(self, key: str):
+        """Возвращает (время создания, варианты) или None"""
+        row = self.conn.execute("SELECT created, variants FROM responses WHERE key = ?", (key,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def save(self, key: str, created: float, variants: List[str]):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, variants, created) VALUES (?, ?, ?)",
+            (key, json.dumps(variants, ensure_ascii=False), created)
+        )
+        self.conn.commit()
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.prune()
+
+    def delete(self, key: str):
+        self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        self.conn.commit()
+
+    def prune(self, expired_before: Optional[float] = None):
+        """Удаляет устаревшие записи и самые старые записи сверх max_entries"""
+        if expired_before is not None:
+            self.conn.execute("DELETE FROM responses WHERE created < ?", (expired_before,))
+        self.conn.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class ResponseCache:
+    """
+    Кэш ответов модели для повторяющихся запросов (первые реплики, вступления /conversation, бои).
+
+    Ключ - хэш нормализованного списка сообщений, имени модели и температуры.
+    На ключ хранится до variants разных ответов: пока они не набраны, запрос считается промахом
+    и идет в модель, потом отдается случайный из вариантов, чтобы ответы не повторялись дословно.
+    В памяти записи вытесняются по LRU, по времени жизни и по суммарному размеру текста;
+    при заданном пути записи дублируются в SQLite и переживают перезапуск.
+    """
+
+    def __init__(self, max_entries: int = 1000, max_chars: int = 10_000_000, ttl: float = 86400,
+                 variants: int = 3, disk_path: Optional[str] = None, disk_max_entries: int = 100000):
+        """
+        Args:
+            max_entries (int): Максимальное число ключей в памяти
+            max_chars (int): Максимальный суммарный размер ответов в памяти, символов
+            ttl (float): Время жизни записи в секундах
+            variants (int): Сколько разных ответов хранить на ключ при ненулевой температуре
+            disk_path (Optional[str]): Путь к базе SQLite для дискового уровня (None - только память)
+            disk_max_entries (int): Максимальное число ключей на диске
+        """
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.ttl = ttl
+        self.variants = variants
+        self.disk = SqliteCacheTier(disk_path, disk_max_entries) if disk_path else None
+        self._entries: OrderedDict = OrderedDict()  # ключ -> [время создания, варианты]
+        self._chars = 0
+        metrics.gauge('bot_cache_entries', "Записей в кэше ответов (в памяти)", lambda: len(self._entries))
+
+    @classmethod
+    def from_env(cls) -> Optional['ResponseCache']:
+        """Создает кэш по настройкам окружения или возвращает None, если кэш выключен"""
+        if os.getenv('RESPONSE_CACHE', '0') != '1':
+            return None
+        return cls(
+            max_entries=int(os.getenv('RESPONSE_CACHE_SIZE', '1000')),
+            max_chars=int(os.getenv('RESPONSE_CACHE_MAX_CHARS', '10000000')),
+            ttl=float(os.getenv('RESPONSE_CACHE_TTL', '86400')),
+            variants=int(os.getenv('RESPONSE_CACHE_VARIANTS', '3')),
+            disk_path=os.getenv('RESPONSE_CACHE_PATH') or None,
+            disk_max_entries=int(os.getenv('RESPONSE_CACHE_DISK_SIZE', '100000'))
+        )
+
+    @staticmethod
+    def make_key(messages: Iterable[Dict[str, str]], model_name: str, temperature: float) -> str:
+        """Хэш нормализованного списка сообщений вместе с моделью и температурой"""
+        digest = hashlib.sha256(f"{model_name}\0{temperature!r}".encode('utf-8'))
+        for message in messages:
+            digest.update(f"\0{message['role']}\0{normalize_text(message['text'])}".encode('utf-8'))
+        return digest.hexdigest()
+
+    def _needed(self, temperature: float) -> int:
+        """Сколько вариантов нужно набрать, прежде чем отдавать ответы из кэша"""
+        return 1 if temperature == 0 else self.variants
+
+    def _drop(self, key: str):
+        _, variants = self._entries.pop(key)
+        self._chars -= sum(len(v) for v in variants)
+
+    def _store(self, key: str, created: float, variants: List[str]):
+        """Кладет запись в память и вытесняет старые записи сверх лимитов"""
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = [created, variants]
+        self._chars += sum(len(v) for v in variants)
+        while self._entries and (len(self._entries) > self.max_entries or self._chars > self.max_chars):
+            self._drop(next(iter(self._entries)))
+
+    def _lookup(self, key: str) -> Optional[list]:
+        """Находит живую запись в памяти или на диске"""
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                return entry
+            self._drop(key)
+        if self.disk is not None:
+            row = self.disk.load(key)
+            if row is not None:
+                if now - row[0] < self.ttl:
+                    self._store(key, *row)
+                    return self._entries[key]
+                self.disk.delete(key)
+        return None
+
+    def get(self, key: str, temperature: float) -> Optional[str]:
+        """Возвращает один из сохраненных ответов или None, если нужно обратиться к модели"""
+        entry = self._lookup(key)
+        if entry is None or len(entry[1]) < self._needed(temperature):
+            cache_total.inc(result='miss')
+            return None
+        cache_total.inc(result='hit')
+        return random.choice(entry[1])
+
+    def put(self, key: str, temperature: float, text: str):
+        """Добавляет ответ как новый вариант для ключа"""
+        entry = self._lookup(key)
+        created, variants = entry if entry is not None else (time.time(), [])
+        if text in variants or len(variants) >= self._needed(temperature):
+            return
+        variants = variants + [text]
+        self._store(key, created, variants)
+        if self.disk is not None:
+            self.disk.save(key, created, variants)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
@@ -0,0 +1,114 @@
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+import asyncio
+import time
+from Metrics import stage_seconds, errors_total
+
+STARTED = 'started'    # Сообщение сразу взято в обработку
+QUEUED = 'queued'      # Все обработчики заняты, чат ждет своей очереди
+MERGED = 'merged'      # Сообщение присоединено к еще не обработанным сообщениям чата
+REJECTED = 'rejected'  # Очередь переполнена
+
+
+class ChatScheduler:
+    """
+    Планировщик генераций с очередью на каждый чат.
+
+    Сообщения одного чата обрабатываются строго по очереди. Если пока генерируется ответ
+    приходят новые сообщения, они объединяются в одну реплику и получают один ответ.
+    Чаты обслуживаются по кругу: после обработки чат с новыми сообщениями встает в конец
+    общей очереди, поэтому один активный чат не может занять все обработчики.
+    """
+
+    def __init__(self, handler: Callable[[int, str, Any], Awaitable[None]],
+                 concurrency: int = 50, max_queue: int = 1000):
+        """
+        Args:
+            handler (Callable): Корутина handler(chat_id, text, context), обрабатывающая реплику
+            concurrency (int): Сколько чатов обрабатывается одновременно
+            max_queue (int): Сколько чатов может ждать в очереди, после этого сообщения отклоняются
+        """
+        self.handler = handler
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self._pending: Dict[int, List[Any]] = {}  # chat_id -> [список текстов, последний context, время постановки]
+        self._in_flight: Set[int] = set()
+        self._ready: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    def _start(self):
+        """Лениво запускает обработчики в текущем цикле событий"""
+        self._ready = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    def submit(self, chat_id: int, text: str, context: Any = None) -> str:
+        """
+        Ставит сообщение чата в очередь.
+
+        Args:
+            chat_id (int): Идентификатор чата
+            text (str): Текст сообщения
+            context (Any): Контекст обработчика Telegram, передается в handler
+
+        Returns:
+            str: STARTED, QUEUED, MERGED или REJECTED
+        """
+        if self._ready is None:
+            self._start()
+
+        entry = self._pending.get(chat_id)
+        if entry is not None:
+            entry[0].append(text)
+            entry[1] = context
+            return MERGED
+
+        if chat_id in self._in_flight:
+            # Ответ уже генерируется: сообщение дождется его и уйдет следующей репликой
+            self._pending[chat_id] = [[text], context, time.monotonic()]
+            return MERGED
+
+        if self._ready.qsize() >= self.max_queue:
+            return REJECTED
+
+        self._pending[chat_id] = [[text], context, time.monotonic()]
+        busy = len(self._in_flight) + self._ready.qsize() >= self.concurrency
+        self._ready.put_nowait(chat_id)
+        return QUEUED if busy else STARTED
+
+    def queue_size(self) -> int:
+        """Число чатов, ожидающих обработки"""
+        return self._ready.qsize() if self._ready is not None else 0
+
+    def in_flight(self) -> int:
+        """Число чатов, для которых сейчас генерируется ответ"""
+        return len(self._in_flight)
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            texts, context, enqueued = self._pending.pop(chat_id)
+            stage_seconds.observe(time.monotonic() - enqueued, stage='queue_wait')
+            self._in_flight.add(chat_id)
+            try:
+                await self.handler(chat_id, '\n'.join(texts), context)
+            except Exception as e:
+                errors_total.inc(where='scheduler')
+                print(f"Ошибка при обработке сообщения чата {chat_id}: {str(e)}")
+            finally:
+                self._in_flight.discard(chat_id)
+                if chat_id in self._pending:
+                    # Новые сообщения чата встают в конец очереди
+                    self._ready.put_nowait(chat_id)
+                self._ready.task_done()
+
+    async def join(self):
+        """Ждет обработки всех поставленных в очередь сообщений"""
+        if self._ready is not None:
+            await self._ready.join()
+
+    async def close(self):
+        """Останавливает обработчики"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._ready = None
@@ -0,0 +1,213 @@
+from collections import OrderedDict
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import json
+import sqlite3
+import time
+
+
+class SqliteBackend:
+    """Хранение выгруженных сессий в локальной базе SQLite"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        # Все известные чаты, в том числе еще не выгруженные: база общая для процессов webhook
+        self.conn.execute("CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY)")
+        self.conn.commit()
+
+    def register(self, chat_id: int):
+        """Запоминает чат, чтобы он был виден в keys() до первой выгрузки сессии"""
+        self.conn.execute("INSERT OR IGNORE INTO chats (chat_id) VALUES (?)", (chat_id,))
+        self.conn.commit()
+
+    def save(self, chat_id: int, data: Dict[str, Any]):
+        """Сохраняет состояние сессии"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sessions (chat_id, data, updated) VALUES (?, ?, ?)",
+            (chat_id, json.dumps(data, ensure_ascii=False), time.time())
+        )
+        self.conn.commit()
+
+    def save_many(self, items: Iterable[Tuple[int, Dict[str, Any]]]):
+        """Сохраняет несколько сессий одной транзакцией: одна фиксация на диск вместо одной на сессию"""
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO sessions (chat_id, data, updated) VALUES (?, ?, ?)",
+            ((chat_id, json.dumps(data, ensure_ascii=False), now) for chat_id, data in items)
+        )
+        self.conn.commit()
+
+    def load(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        """Загружает состояние сессии или возвращает None"""
+        row = self.conn.execute("SELECT data FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete(self, chat_id: int):
+        """Удаляет сессию из базы"""
+        self.conn.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+        self.conn.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
+        self.conn.commit()
+
+    def __contains__(self, chat_id: int) -> bool:
+        return self.conn.execute("SELECT 1 FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone() is not None
+
+    def keys(self) -> List[int]:
+        """Возвращает идентификаторы всех сохраненных сессий"""
+        return [row[0] for row in self.conn.execute("SELECT chat_id FROM sessions UNION SELECT chat_id FROM chats")]
+
+    def close(self):
+        self.conn.close()
+
+
+class SessionStore:
+    """
+    Ограниченное хранилище активных диалогов с вытеснением LRU и по времени простоя.
+    Вытесненные сессии записываются в backend (если он задан) и лениво
+    восстанавливаются при следующем обращении. При запуске ничего не загружается.
+
+    Хранимые объекты должны иметь метод to_dict(), а loader восстанавливает объект из словаря.
+    """
+
+    def __init__(self, loader: Callable[[Dict[str, Any]], Any], backend: Optional[SqliteBackend] = None,
+                 max_sessions: int = 10000, idle_ttl: float = 3600, sweep_interval: float = 60):
+        """
+        Args:
+            loader (Callable): Функция восстановления объекта из словаря
+            backend (Optional[SqliteBackend]): Постоянное хранилище; без него вытесненные сессии теряются
+            max_sessions (int): Максимальное число сессий в памяти
+            idle_ttl (float): Время простоя в секундах, после которого сессия выгружается
+            sweep_interval (float): Минимальный интервал между проверками простоя в секундах
+        """
+        self.loader = loader
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self._sessions: OrderedDict = OrderedDict()  # chat_id -> [объект, время последнего обращения]
+        self._last_sweep = time.monotonic()
+
+    def _evict(self, chat_ids: List[int]):
+        """Выгружает сессии из памяти, сохраняя их в backend одной транзакцией"""
+        batch = []
+        for chat_id in chat_ids:
+            obj, _ = self._sessions.pop(chat_id)
+            if self.backend is not None:
+                try:
+                    batch.append((chat_id, obj.to_dict()))
+                except Exception as e:
+                    print(f"Ошибка при сохранении сессии {chat_id}: {str(e)}")
+        if batch:
+            try:
+                self.backend.save_many(batch)
+            except Exception as e:
+                print(f"Ошибка при сохранении {len(batch)} сессий: {str(e)}")
+
+    def sweep(self, force: bool = False):
+        """Выгружает сессии сверх лимита и сессии, простаивающие дольше idle_ttl"""
+        now = time.monotonic()
+        expired = []
+        over_limit = len(self._sessions) - self.max_sessions
+        if over_limit > 0:
+            expired.extend(islice(self._sessions, over_limit))
+
+        if force or now - self._last_sweep >= self.sweep_interval:
+            self._last_sweep = now
+            # Сессии упорядочены по времени обращения, поэтому достаточно смотреть с начала
+            for chat_id, (_, last_access) in islice(self._sessions.items(), len(expired), None):
+                if now - last_access < self.idle_ttl:
+                    break
+                expired.append(chat_id)
+
+        if expired:
+            self._evict(expired)
+
+    def get(self, chat_id: int, default: Any = None) -> Any:
+        """Возвращает сессию, при необходимости восстанавливая ее из backend"""
+        entry = self._sessions.get(chat_id)
+        if entry is not None:
+            entry[1] = time.monotonic()
+            self._sessions.move_to_end(chat_id)
+            self.sweep()  # Простаивающие сессии выгружаются и без новых чатов
+            return entry[0]
+
+        if self.backend is None:
+            return default
+        data = self.backend.load(chat_id)
+        if data is None:
+            return default
+        try:
+            obj = self.loader(data)
+        except Exception as e:
+            print(f"Ошибка при восстановлении сессии {chat_id}: {str(e)}")
+            return default
+        self[chat_id] = obj
+        return obj
+
+    def __getitem__(self, chat_id: int) -> Any:
+        obj = self.get(chat_id)
+        if obj is None:
+            raise KeyError(chat_id)
+        return obj
+
+    def __setitem__(self, chat_id: int, obj: Any):
+        if self.backend is not None and chat_id not in self._sessions:
+            try:
+                self.backend.register(chat_id)
+            except Exception as e:
+                print(f"Ошибка при регистрации чата {chat_id}: {str(e)}")
+        self._sessions[chat_id] = [obj, time.monotonic()]
+        self._sessions.move_to_end(chat_id)
+        self.sweep()
+
+    def __delitem__(self, chat_id: int):
+        found = self._sessions.pop(chat_id, None) is not None
+        if self.backend is not None:
+            found = chat_id in self.backend or found
+            self.backend.delete(chat_id)  # Удаляет и регистрацию чата
+        if not found:
+            raise KeyError(chat_id)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._sessions or (self.backend is not None and chat_id in self.backend)
+
+    def keys(self) -> List[int]:
+        """Идентификаторы всех сессий: активных и выгруженных"""
+        keys = list(self._sessions.keys())
+        if self.backend is not None:
+            active = set(keys)
+            keys.extend(chat_id for chat_id in self.backend.keys() if chat_id not in active)
+        return keys
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.keys())
+
+    def active_count(self) -> int:
+        """Число сессий, находящихся в памяти"""
+        return len(self._sessions)
+
+    def flush(self):
+        """Сохраняет все сессии из памяти в backend (например, при остановке бота)"""
+        if self.backend is None:
+            return
+        batch = []
+        for chat_id, (obj, _) in self._sessions.items():
+            try:
+                batch.append((chat_id, obj.to_dict()))
+            except Exception as e:
+                print(f"Ошибка при сохранении сессии {chat_id}: {str(e)}")
+        try:
+            self.backend.save_many(batch)
+        except Exception as e:
+            print(f"Ошибка при сохранении {len(batch)} сессий: {str(e)}")
+
+    def close(self):
+        """Сохраняет сессии и закрывает backend"""
+        self.flush()
+        if self.backend is not None:
+            self.backend.close()
@@ -0,0 +1,269 @@
+"""
+Режим webhook с несколькими процессами-обработчиками.
+
+Основной процесс принимает обновления Telegram локальным HTTP сервером и раскладывает их
+по очередям рабочих процессов. Чат всегда попадает в один и тот же процесс (chat_id % число процессов),
+поэтому его Dialogue живет только в одном процессе. Каждый рабочий процесс запускает
+собственное приложение BotMain без polling.
+
+Запуск:
+    python Webhook.py
+
+Команды /to_all и /to_all_resume всегда выполняет процесс 0. Получатели берутся из общей базы сессий
+(SESSION_BACKEND=sqlite), где регистрируется каждый чат, поэтому рассылка доходит и до чатов других процессов.
+
+SIGINT/SIGTERM - корректная остановка: прием обновлений прекращается, процессы дожидаются
+текущих генераций. SIGHUP - поочередный перезапуск процессов без потери обновлений.
+"""
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+from dotenv import load_dotenv
+import asyncio
+import hmac
+import json
+import multiprocessing
+import os
+import signal
+
+STOP = None  # Сигнал рабочему процессу завершиться
+
+
+def chat_id_of(update: dict) -> int:
+    """Извлекает идентификатор чата из необработанного обновления Telegram"""
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if key in update:
+            return update[key]['chat']['id']
+    if 'callback_query' in update:
+        query = update['callback_query']
+        if 'message' in query:
+            return query['message']['chat']['id']
+        return query['from']['id']
+    for key in ('my_chat_member', 'chat_member', 'chat_join_request'):
+        if key in update:
+            return update[key]['chat']['id']
+    for value in update.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return 0
+
+
+def shard_of(chat_id: int, workers: int) -> int:
+    return abs(chat_id) % workers
+
+
+# Команды рассылки выполняет один процесс: у него общий файл прогресса и признак идущей рассылки
+BROADCAST_COMMANDS = ('/to_all', '/to_all_resume')
+BROADCAST_SHARD = 0
+
+
+def is_broadcast_command(update: dict) -> bool:
+    text = update.get('message', {}).get('text', '')
+    command = text.split(maxsplit=1)[0].split('@')[0] if text.startswith('/') else ''
+    return command in BROADCAST_COMMANDS
+
+
+# --- Рабочий процесс ---
+
+def worker_main(index: int, queue: multiprocessing.Queue):
+    """Точка входа рабочего процесса"""
+    # Остановкой управляет основной процесс: сигнал всей группе процессов (systemd, kill -- -pgid)
+    # не должен прерывать обработчик, иначе он не дождется текущих ответов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    load_dotenv()
+    base_port = int(os.getenv('METRICS_PORT', '9090'))
+    if base_port:
+        os.environ['METRICS_PORT'] = str(base_port + index)  # У каждого процесса свой порт метрик
+    asyncio.run(_worker(index, queue))
+
+
+async def _worker(index: int, queue: multiprocessing.Queue):
+    import BotMain
+    from telegram import Update
+
+    application = BotMain.build_application(os.environ['BOT_TOKEN'], polling=False)
+    drain_timeout = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '30'))
+    loop = asyncio.get_running_loop()
+
+    async with application:
+        await BotMain.on_startup(application)
+        await application.start()
+        print(f"Обработчик {index} запущен (pid {os.getpid()})")
+        try:
+            while True:
+                data = await loop.run_in_executor(None, queue.get)
+                if data is STOP:
+                    break
+                try:
+                    update = Update.de_json(json.loads(data), application.bot)
+                    await application.update_queue.put(update)
+                except Exception as e:
+                    print(f"Обработчик {index}: некорректное обновление: {str(e)}")
+        finally:
+            # Дожидаемся обработки принятых обновлений и текущих генераций
+            try:
+                await asyncio.wait_for(_drain(application), drain_timeout)
+            except asyncio.TimeoutError:
+                print(f"Обработчик {index}: не все генерации завершились за {drain_timeout} с")
+            await application.stop()
+            await BotMain.on_shutdown(application)
+    print(f"Обработчик {index} остановлен")
+
+
+async def _drain(application):
+    import BotMain
+    while not application.update_queue.empty():
+        await asyncio.sleep(0.1)
+    await BotMain.scheduler.join()
+
+
+# --- Основной процесс ---
+
+class WebhookServer:
+    """HTTP сервер webhook и пул рабочих процессов"""
+
+    def __init__(self, token: str, url: str, listen: str, port: int, secret: Optional[str], workers: int):
+        self.token = token
+        self.url = url
+        self.path = urlparse(url).path or '/'
+        self.listen = listen
+        self.port = port
+        self.secret = secret
+        self.workers = workers
+        self.context = multiprocessing.get_context('spawn')  # gRPC не переносит fork
+        self.queues: List[multiprocessing.Queue] = [self.context.Queue() for _ in range(workers)]
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        self.stopping = False
+        self._restarting = set()
+        if workers > 1 and os.getenv('SESSION_BACKEND', 'sqlite') != 'sqlite':
+            print("Внимание: без SESSION_BACKEND=sqlite процессы не видят чужие чаты, /to_all дойдет не до всех")
+
+    def _start_worker(self, index: int):
+        process = self.context.Process(target=worker_main, args=(index, self.queues[index]), daemon=False)
+        process.start()
+        self.processes[index] = process
+
+    async def _stop_worker(self, index: int, timeout: float):
+        """Просит процесс завершиться и ждет, пока он допишет текущие ответы"""
+        process = self.processes[index]
+        self.queues[index].put(STOP)
+        await asyncio.get_running_loop().run_in_executor(None, process.join, timeout)
+        if process.is_alive():
+            print(f"Обработчик {index} не завершился вовремя, принудительная остановка")
+            process.kill()  # SIGTERM обработчик игнорирует
+
+    async def restart_workers(self):
+        """Поочередный перезапуск: обновления для перезапускаемого процесса копятся в его очереди"""
+        timeout = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '30')) + 5
+        for index in range(self.workers):
+            self._restarting.add(index)
+            await self._stop_worker(index, timeout)
+            self._start_worker(index)
+            self._restarting.discard(index)
+
+    async def _watchdog(self):
+        """Перезапускает неожиданно завершившиеся процессы"""
+        while not self.stopping:
+            await asyncio.sleep(1)
+            for index, process in list(self.processes.items()):
+                if not process.is_alive() and index not in self._restarting and not self.stopping:
+                    print(f"Обработчик {index} завершился с кодом {process.exitcode}, перезапуск")
+                    self._start_worker(index)
+
+    def _dispatch(self, body: bytes):
+        update = json.loads(body)
+        shard = BROADCAST_SHARD if is_broadcast_command(update) else shard_of(chat_id_of(update), self.workers)
+        self.queues[shard].put(body.decode('utf-8'))
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', '0')))
+
+                parts = request_line.decode('latin-1').split()
+                status = '200 OK'
+                if len(parts) < 2 or parts[0] != 'POST' or parts[1] != self.path:
+                    status = '404 Not Found'
+                elif self.secret and not hmac.compare_digest(
+                        headers.get('x-telegram-bot-api-secret-token', ''), self.secret):
+                    status = '403 Forbidden'
+                elif self.stopping:
+                    status = '503 Service Unavailable'  # Telegram повторит доставку позже
+                else:
+                    try:
+                        self._dispatch(body)
+                    except Exception as e:
+                        print(f"Некорректное обновление: {str(e)}")
+                        status = '400 Bad Request'
+
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n\r\n".encode())
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self):
+        from telegram import Bot
+
+        for index in range(self.workers):
+            self._start_worker(index)
+
+        async with Bot(self.token) as bot:
+            await bot.set_webhook(url=self.url, secret_token=self.secret)
+
+        server = await asyncio.start_server(self._handle, self.listen, self.port)
+        print(f"Webhook слушает {self.listen}:{self.port}{self.path}, процессов: {self.workers}")
+
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.restart_workers()))
+
+        watchdog = asyncio.create_task(self._watchdog())
+        await stop.wait()
+
+        print("Остановка: прием обновлений прекращен, ожидание обработчиков...")
+        self.stopping = True
+        server.close()
+        await server.wait_closed()
+        watchdog.cancel()
+        timeout = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '30')) + 5
+        await asyncio.gather(*(self._stop_worker(index, timeout) for index in range(self.workers)))
+
+
+def main():
+    load_dotenv()
+    token = os.environ.get('BOT_TOKEN')
+    url = os.environ.get('WEBHOOK_URL')
+    if not token:
+        raise ValueError("Токен бота не найден в переменных среды!")
+    if not url:
+        raise ValueError("Не задан WEBHOOK_URL!")
+
+    server = WebhookServer(
+        token=token,
+        url=url,
+        listen=os.getenv('WEBHOOK_LISTEN', '127.0.0.1'),
+        port=int(os.getenv('WEBHOOK_PORT', '8443')),
+        secret=os.getenv('WEBHOOK_SECRET') or None,
+        workers=int(os.getenv('WEBHOOK_WORKERS', str(os.cpu_count() or 1)))
+    )
+    asyncio.run(server.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -10,4 +10,14 @@ FIGHT_PROMPT = """
 Однако, если указания глупые или бессмысленные, пошлые или грубые, совершенно не соответствуют бою, 
 то укажи это перед описанием боя и избегай их.
 Бой заканчивается либо смертью, либо капитуляцией одного из участников. После описания боя опиши вкратце, что 
-арена исчезает, персонаж приходит в норму."""
\ No newline at end of file
+арена исчезает, персонаж приходит в норму."""
+
+SUMMARY_PROMPT = """
+Ты ведешь краткое содержание диалога между пользователем и персонажем.
+Тебе дано текущее краткое содержание (может быть пустым) и новые реплики.
+Обнови краткое содержание так, чтобы в нем остались важные факты, имена, договоренности и тон беседы.
+Пиши от третьего лица, не более пяти предложений, без вступлений и пояснений."""
+
+CONVERSATION_PARTICIPANTS = "Ты участвуешь в разговоре. Твои собеседники: {names}. Их реплики приходят в виде 'Имя: текст'. Отвечай только своей репликой, без имени в начале."
+
+CONVERSATION_OPENING = "Начни диалог с представления себя и обращения к собеседникам"
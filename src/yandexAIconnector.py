@@ -1,50 +1,469 @@
-
-from typing import List, Dict, Optional
-from yandex_cloud_ml_sdk import YCloudML
+from typing import List, Dict, Optional, Tuple, Any, AsyncIterator, Iterator, Sequence, Union
+from yandex_cloud_ml_sdk import YCloudML, AsyncYCloudML
 from dotenv import load_dotenv
+import asyncio
 import os
+import random
+import time
+from Metrics import (metrics, record_usage, errors_total, retries_total, stage_seconds,
+                     hedges_total, fallbacks_total)
+from History import History, HistoryView, Message
+from ResponseCache import ResponseCache
+
+class ClientPool:
+    """
+    Общий на весь процесс набор клиентов YandexGPT.
+    SDK и настроенные модели создаются один раз и переиспользуются всеми персонажами,
+    поэтому создание новой сессии не требует повторной авторизации и открытия каналов.
+    """
 
-class DialogueManager:
     def __init__(self):
         load_dotenv()
         self.ya_folder = os.getenv('YA_FOLDER')
         self.ya_api_key = os.getenv('YA_API_KEY')
-        self.temperature = float(os.getenv('TEMPERATURE', '0.6'))
-        
+
         if not all([self.ya_folder, self.ya_api_key]):
             raise ValueError("Не найдены необходимые ключи окружения")
-            
+
         self.sdk = YCloudML(
             folder_id=self.ya_folder,
             auth=self.ya_api_key,
         )
-        self.model = self.sdk.models.completions("yandexgpt")
-        self.model = self.model.configure(temperature=self.temperature)
-    
-    def get_reply(self, message_history: List[Dict[str, str]], system_line: Optional[str] = None) -> str:
+        # Асинхронный клиент: не блокирует цикл событий на время запроса
+        self.async_sdk = AsyncYCloudML(
+            folder_id=self.ya_folder,
+            auth=self.ya_api_key,
+        )
+        self._models = {}
+
+    def get_models(self, model_name: str, temperature: float) -> Tuple[Any, Any]:
         """
-        Получает ответ от YandexGPT на историю сообщений.
-        
+        Возвращает пару (синхронная, асинхронная) модель с заданными настройками.
+        Настроенные модели кэшируются, каналы SDK общие для всех моделей.
+
         Args:
-            message_history (List[Dict[str, str]]): История сообщений
-            system_line (Optional[str]): Системный контекст
-            
+            model_name (str): Имя модели, например "yandexgpt"
+            temperature (float): Температура генерации
+
         Returns:
-            str: Ответ модели
+            Tuple[Any, Any]: Синхронная и асинхронная модели
+        """
+        key = (model_name, temperature)
+        if key not in self._models:
+            model = self.sdk.models.completions(model_name).configure(temperature=temperature)
+            async_model = self.async_sdk.models.completions(model_name).configure(temperature=temperature)
+            self._models[key] = (model, async_model)
+        return self._models[key]
+
+    async def close(self):
+        """Закрывает открытые gRPC каналы асинхронного клиента"""
+        # У SDK нет публичного метода закрытия, каналы хранятся в клиенте
+        channels = getattr(self.async_sdk._client, '_channels', {})
+        for channel in list(channels.values()):
+            try:
+                await channel.close()
+            except Exception as e:
+                print(f"Ошибка при закрытии канала YandexGPT: {str(e)}")
+        channels.clear()
+        self._models.clear()
+
+
+_pool: Optional[ClientPool] = None
+_shared_manager: Optional['DialogueManager'] = None
+
+
+def get_client_pool() -> ClientPool:
+    """Возвращает общий пул клиентов, создавая его при первом обращении"""
+    global _pool
+    if _pool is None:
+        _pool = ClientPool()
+    return _pool
+
+
+def get_dialogue_manager() -> 'DialogueManager':
+    """Возвращает общий для всех персонажей менеджер диалогов"""
+    global _shared_manager
+    if _shared_manager is None:
+        _shared_manager = DialogueManager()
+    return _shared_manager
+
+
+async def startup(*args):
+    """Хук запуска: заранее создает пул клиентов, чтобы первый запрос не платил за инициализацию"""
+    get_dialogue_manager()
+
+
+async def shutdown(*args):
+    """Хук остановки: закрывает каналы и сбрасывает общий пул"""
+    global _pool, _shared_manager
+    if _shared_manager is not None and _shared_manager.cache is not None:
+        _shared_manager.cache.close()
+    if _pool is not None:
+        await _pool.close()
+    _pool = None
+    _shared_manager = None
+
+
+class CircuitBreaker:
+    """
+    Размыкатель для основной модели.
+    После failures ошибок подряд модель считается деградировавшей, и запросы уходят в резервную.
+    Через reset_timeout секунд пропускается один пробный запрос: успех замыкает цепь, ошибка - снова размыкает.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failures: int, reset_timeout: float):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._errors = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос в основную модель"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self._errors = 0
+        self._probing = False
+
+    def record_failure(self):
+        self._errors += 1
+        if self.state == self.HALF_OPEN or self._errors >= self.failures:
+            if self.state != self.OPEN:
+                print(f"YandexGPT: основная модель недоступна, запросы идут в резервную на {self.reset_timeout:g} с")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._probing = False
+
+    def release(self):
+        """Запрос прерван без результата (отмена): пробный запрос можно отправить снова"""
+        self._probing = False
+
+
+class DialogueManager:
+    # Глобальное ограничение числа одновременных запросов к YandexGPT (на весь процесс)
+    _semaphore: Optional[asyncio.Semaphore] = None
+    # Сколько замеров задержки нужно, чтобы доверять p95 при дублировании запросов
+    HEDGE_MIN_SAMPLES = 20
+
+    def __init__(self, pool: Optional[ClientPool] = None, model_name: str = "yandexgpt"):
+        self.pool = pool or get_client_pool()
+        self.temperature = float(os.getenv('TEMPERATURE', '0.6'))
+        self.max_concurrent = int(os.getenv('MAX_CONCURRENT_REQUESTS', '100'))
+        self.timeout = float(os.getenv('LLM_TIMEOUT', '30'))
+        self.max_retries = int(os.getenv('LLM_MAX_RETRIES', '2'))
+        self.backoff = float(os.getenv('LLM_BACKOFF', '0.5'))
+        self.hedge = os.getenv('LLM_HEDGE', '1') == '1'
+        self.model_name = model_name
+        self.cache = ResponseCache.from_env()  # Кэш повторяющихся запросов (RESPONSE_CACHE=1)
+        self.model, self.async_model = self.pool.get_models(model_name, self.temperature)
+
+        # Резервная быстрая модель на время, пока основная деградировала
+        fallback_name = os.getenv('LLM_FALLBACK_MODEL', 'yandexgpt-lite')
+        self.fallback_model = self.async_fallback_model = None
+        if fallback_name and fallback_name != model_name:
+            self.fallback_model, self.async_fallback_model = self.pool.get_models(fallback_name, self.temperature)
+        self.breaker = CircuitBreaker(
+            failures=int(os.getenv('LLM_BREAKER_FAILURES', '5')),
+            reset_timeout=float(os.getenv('LLM_BREAKER_RESET', '30'))
+        )
+        metrics.gauge('bot_llm_breaker_open', "Основная модель отключена размыкателем (1 - да)",
+                      lambda: float(self.breaker.state != CircuitBreaker.CLOSED))
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        """Возвращает общий семафор, ограничивающий число запросов в полете"""
+        if DialogueManager._semaphore is None:
+            DialogueManager._semaphore = asyncio.Semaphore(self.max_concurrent)
+        return DialogueManager._semaphore
+
+    def _build_messages(self, message_history: Sequence[Union[Dict[str, str], Message]],
+                        system_line: Optional[str] = None) -> Iterator[Dict[str, str]]:
         """
-        if not message_history or not isinstance(message_history, list):
+        Проверяет историю сообщений и возвращает ленивый итератор сообщений для SDK.
+        История не копируется; History и HistoryView состоят из сообщений, уже проверенных
+        при добавлении, поэтому полностью проверяются только списки словарей.
+        """
+        if not message_history or not isinstance(message_history, (list, tuple, History, HistoryView)):
             raise ValueError("История сообщений должна быть непустым списком")
-            
+        if isinstance(message_history, (History, HistoryView)):
+            return self._iter_messages(message_history, system_line)
+
         for message in message_history:
-            if not isinstance(message, dict) or 'role' not in message or 'text' not in message:
+            if type(message) is not Message and (
+                    not isinstance(message, dict) or 'role' not in message or 'text' not in message):
                 raise ValueError("Некорректный формат сообщения")
-        
-        messages = message_history.copy()
+
+        return self._iter_messages(message_history, system_line)
+
+    @staticmethod
+    def _iter_messages(message_history, system_line: Optional[str]) -> Iterator[Dict[str, str]]:
+        if isinstance(message_history, (History, HistoryView)):
+            yield from message_history.iter_dicts()  # Словари общего префикса не пересоздаются
+        else:
+            for message in message_history:
+                yield message.as_dict() if type(message) is Message else message
         if system_line:
-            messages.append({'role': 'system', 'text': system_line})
-        
+            yield {'role': 'system', 'text': system_line}
+
+    def _cache_key(self, message_history, system_line: Optional[str], cache: bool) -> Optional[str]:
+        """Ключ кэша ответов, если кэш включен и запрос помечен как повторяющийся"""
+        if not cache or self.cache is None:
+            return None
+        return ResponseCache.make_key(self._iter_messages(message_history, system_line),
+                                      self.model_name, self.temperature)
+
+    def _choose_model(self, sync: bool = False) -> Tuple[Any, bool]:
+        """Возвращает модель для очередной попытки и признак того, что это основная модель"""
+        fallback = self.fallback_model if sync else self.async_fallback_model
+        if fallback is None or self.breaker.allow():
+            return (self.model if sync else self.async_model), True
+        fallbacks_total.inc()
+        return fallback, False
+
+    def _retry_delay(self, attempt: int) -> float:
+        """Экспоненциальная задержка перед повтором со случайным разбросом"""
+        return min(10.0, self.backoff * 2 ** attempt) * (0.5 + random.random())
+
+    def _hedge_delay(self) -> Optional[float]:
+        """Через сколько секунд отправлять дублирующий запрос: p95 задержки основной модели"""
+        if not self.hedge:
+            return None
+        series = stage_seconds.series.get((('stage', 'llm'),))
+        if not series or series[2] < self.HEDGE_MIN_SAMPLES:
+            return None
+        delay = stage_seconds.quantile(0.95, stage='llm')
+        return delay if delay < self.timeout else None
+
+    async def _request(self, model, primary: bool, message_history, system_line: Optional[str]):
+        """Один запрос к модели с ограничением по времени; в метрику задержки попадают только успешные"""
+        started = time.perf_counter()
+        response = await asyncio.wait_for(
+            model.run(messages=self._iter_messages(message_history, system_line), timeout=self.timeout),
+            self.timeout
+        )
+        stage_seconds.observe(time.perf_counter() - started, stage='llm' if primary else 'llm_fallback')
+        return response
+
+    async def _hedged_request(self, model, primary: bool, message_history, system_line: Optional[str]):
+        """
+        Запрос с дублированием: если ответ не пришел за p95 обычной задержки,
+        отправляется второй такой же запрос и берется тот ответ, что придет первым.
+        Вызывается с уже занятым местом в семафоре; дублирующий запрос занимает второе место,
+        а если свободных мест нет, не отправляется, чтобы не превышать MAX_CONCURRENT_REQUESTS.
+        """
+        first = asyncio.ensure_future(self._request(model, primary, message_history, system_line))
+        delay = self._hedge_delay() if primary else None
+        if delay is None:
+            return await first
+
+        tasks = {first}
         try:
-            response = self.model.run(messages=messages)
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                if self._get_semaphore().locked():
+                    hedges_total.inc(outcome='skipped')
+                else:
+                    hedges_total.inc(outcome='sent')
+                    tasks.add(asyncio.ensure_future(self._hedge(model, primary, message_history, system_line)))
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            hedges_total.inc(outcome='won')
+                        return task.result()
+            return first.result()  # Оба запроса завершились ошибкой
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _hedge(self, model, primary: bool, message_history, system_line: Optional[str]):
+        """Дублирующий запрос со своим местом в семафоре"""
+        async with self._get_semaphore():
+            return await self._request(model, primary, message_history, system_line)
+
+    def get_reply(self, message_history: List[Dict[str, str]], system_line: Optional[str] = None,
+                  character: Optional[str] = None, cache: bool = False) -> str:
+        """
+        Получает ответ от YandexGPT на историю сообщений.
+        Ошибки и превышение LLM_TIMEOUT повторяются до LLM_MAX_RETRIES раз.
+
+        Args:
+            message_history (List[Dict[str, str]]): История сообщений
+            system_line (Optional[str]): Системный контекст
+            character (Optional[str]): Имя персонажа для учета токенов в метриках
+            cache (bool): Запрос повторяется между пользователями, ответ можно брать из кэша
+
+        Returns:
+            str: Ответ модели
+        """
+        self._build_messages(message_history, system_line)
+        key = self._cache_key(message_history, system_line, cache)
+        if key is not None:
+            cached = self.cache.get(key, self.temperature)
+            if cached is not None:
+                return cached
+
+        for attempt in range(self.max_retries + 1):
+            model, primary = self._choose_model(sync=True)
+            started = time.perf_counter()
+            try:
+                response = model.run(messages=self._iter_messages(message_history, system_line),
+                                     timeout=self.timeout)
+                # Как и в асинхронном пути, задержка учитывается только для успешных запросов
+                stage_seconds.observe(time.perf_counter() - started, stage='llm' if primary else 'llm_fallback')
+            except Exception as e:
+                errors_total.inc(where='llm')
+                if primary:
+                    self.breaker.record_failure()
+                if attempt == self.max_retries:
+                    raise Exception(f"Ошибка YandexGPT: {str(e)}")
+                retries_total.inc(where='llm')
+                time.sleep(self._retry_delay(attempt))
+                continue
+            except BaseException:
+                if primary:
+                    self.breaker.release()
+                raise
+            if primary:
+                self.breaker.record_success()
+                if key is not None:
+                    self.cache.put(key, self.temperature, response.alternatives[0].text)
+            record_usage(character, getattr(response, 'usage', None))
             return response.alternatives[0].text
-        except Exception as e:
-            raise Exception(f"Ошибка YandexGPT: {str(e)}")
\ No newline at end of file
+
+    async def get_reply_async(self, message_history: List[Dict[str, str]], system_line: Optional[str] = None,
+                             character: Optional[str] = None, cache: bool = False) -> str:
+        """
+        Асинхронно получает ответ от YandexGPT, не блокируя цикл событий.
+        Число одновременных запросов ограничено MAX_CONCURRENT_REQUESTS.
+        Медленный запрос дублируется (LLM_HEDGE), ошибки повторяются с задержкой,
+        а при деградации основной модели запросы уходят в LLM_FALLBACK_MODEL.
+
+        Args:
+            message_history (List[Dict[str, str]]): История сообщений
+            system_line (Optional[str]): Системный контекст
+            character (Optional[str]): Имя персонажа для учета токенов в метриках
+            cache (bool): Запрос повторяется между пользователями, ответ можно брать из кэша
+
+        Returns:
+            str: Ответ модели
+        """
+        self._build_messages(message_history, system_line)
+        key = self._cache_key(message_history, system_line, cache)
+        if key is not None:
+            cached = self.cache.get(key, self.temperature)
+            if cached is not None:
+                return cached
+
+        for attempt in range(self.max_retries + 1):
+            model, primary = self._choose_model()
+            try:
+                # Место в семафоре занимается на время запроса, но не на время паузы перед повтором
+                async with self._get_semaphore():
+                    response = await self._hedged_request(model, primary, message_history, system_line)
+            except Exception as e:
+                errors_total.inc(where='llm')
+                if primary:
+                    self.breaker.record_failure()
+                if attempt == self.max_retries:
+                    if isinstance(e, asyncio.TimeoutError):
+                        e = f"нет ответа за {self.timeout:g} с"
+                    raise Exception(f"Ошибка YandexGPT: {str(e)}")
+                retries_total.inc(where='llm')
+                await asyncio.sleep(self._retry_delay(attempt))
+                continue
+            except BaseException:
+                # Отмена (CancelledError) или закрытие потока не должны оставлять пробный запрос занятым
+                if primary:
+                    self.breaker.release()
+                raise
+            if primary:
+                self.breaker.record_success()
+                if key is not None:
+                    self.cache.put(key, self.temperature, response.alternatives[0].text)
+            record_usage(character, getattr(response, 'usage', None))
+            return response.alternatives[0].text
+
+    async def stream_reply_async(self, message_history: List[Dict[str, str]], system_line: Optional[str] = None,
+                                character: Optional[str] = None, cache: bool = False) -> AsyncIterator[str]:
+        """
+        Потоковое получение ответа от YandexGPT.
+        Выдает накопленный текст ответа по мере генерации; последний элемент - полный ответ.
+        Повтор возможен только до первого фрагмента; каждый фрагмент ждется не дольше LLM_TIMEOUT.
+
+        Args:
+            message_history (List[Dict[str, str]]): История сообщений
+            system_line (Optional[str]): Системный контекст
+            character (Optional[str]): Имя персонажа для учета токенов в метриках
+            cache (bool): Запрос повторяется между пользователями, ответ можно брать из кэша
+
+        Yields:
+            str: Текст ответа, сгенерированный к текущему моменту
+        """
+        self._build_messages(message_history, system_line)
+        key = self._cache_key(message_history, system_line, cache)
+        if key is not None:
+            cached = self.cache.get(key, self.temperature)
+            if cached is not None:
+                yield cached  # Готовый ответ выдается целиком
+                return
+
+        for attempt in range(self.max_retries + 1):
+            model, primary = self._choose_model()
+            stage = 'llm' if primary else 'llm_fallback'
+            result, first = None, True
+            try:
+                # Место в семафоре занимается на время генерации, но не на время паузы перед повтором
+                async with self._get_semaphore():
+                    started = time.perf_counter()
+                    stream = model.run_stream(messages=self._iter_messages(message_history, system_line),
+                                              timeout=self.timeout)
+                    try:
+                        while True:
+                            try:
+                                result = await asyncio.wait_for(stream.__anext__(), self.timeout)
+                            except StopAsyncIteration:
+                                break
+                            if first:
+                                stage_seconds.observe(time.perf_counter() - started, stage=f'{stage}_first_token')
+                                first = False
+                            yield result.alternatives[0].text
+                    finally:
+                        aclose = getattr(stream, 'aclose', None)
+                        if aclose is not None:
+                            await aclose()
+            except Exception as e:
+                errors_total.inc(where='llm')
+                if primary:
+                    self.breaker.record_failure()
+                if not first or attempt == self.max_retries:
+                    if isinstance(e, asyncio.TimeoutError):
+                        e = f"нет ответа за {self.timeout:g} с"
+                    raise Exception(f"Ошибка YandexGPT: {str(e)}")
+                retries_total.inc(where='llm')
+                await asyncio.sleep(self._retry_delay(attempt))
+                continue
+            except BaseException:
+                # Отмена (CancelledError) или закрытие потока не должны оставлять пробный запрос занятым
+                if primary:
+                    self.breaker.release()
+                raise
+            if primary:
+                self.breaker.record_success()
+                if key is not None and result is not None:
+                    self.cache.put(key, self.temperature, result.alternatives[0].text)
+            stage_seconds.observe(time.perf_counter() - started, stage=stage)
+            record_usage(character, getattr(result, 'usage', None))
+            return